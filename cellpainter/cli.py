@@ -2,6 +2,7 @@ from __future__ import annotations
 from typing import Any
 
 import argparse
+import contextlib
 import os
 import sys
 import json
@@ -20,7 +21,12 @@ from . import utils
 from . import estimates
 from . import moves
 
-from .execute import execute_program
+from .execute import execute_program, schedule_program
+from .critical_path import critical_path
+from .robustness import robustness
+from .montecarlo import montecarlo
+from .event_store import EventStore
+from .robotarm_standin import RobotarmStandin
 from .log import Log
 from .moves import movelists
 from .runtime import RuntimeConfig, configs, config_lookup
@@ -72,12 +78,22 @@ class Args:
     resume_skip:               str  = arg(help='Comma-separated list of simple_id:s to skip (washes and dispenses)')
     resume_drop:               str  = arg(help='Comma-separated list of plate_id:s to drop')
     resume_time_now:           str  = arg(help='Use this time as current time instead of datetime.now()')
+    resume_strict:             bool = arg(help='Fail instead of resuming with the previous schedule if the rest cannot be rescheduled')
 
     test_resume:               str  = arg(help='Test resume by running twice, second time by resuming from just before the argument id')
     test_resume_delay:         int  = arg(help='Test resume simulated delay')
 
     visualize:                 bool = arg(help='Run detailed protocol visualizer')
     init_cmd_for_visualize:    str  = arg(help='Starting cmdline for visualizer')
+    solve_timeout:             float = arg(default=5.0, help='Seconds the visualizer spends scheduling before using the best schedule found so far')
+    integer_time:              bool = arg(help='Schedule in integer milliseconds when using z3')
+    critical_path:             bool = arg(help='Print the critical path of the schedule and the time estimates with least slack instead of running')
+    risk:                      float = arg(help='Schedule with this percentile of the timings in estimates.json, such as 90, when it is above their average')
+    robustness:                bool = arg(help='Print the probability that each incubation is on time given the spread of the timings instead of running')
+    monte_carlo:               int  = arg(help='Simulate the schedule this many times with durations drawn from the timings in estimates.json and print the distributions instead of running')
+
+    sweep:                     str  = arg(help='Schedule all interleavings, final wash and lockstep options for batch sizes separated by space (such as "6,6 7,7") and print a table of makespans')
+    sweep_incu:                str  = arg(help='Incubation times to sweep over separated by space (default: --incu)')
 
     list_imports:              bool = arg(help='Print the imported python modules for type checking.')
 
@@ -87,6 +103,16 @@ class Args:
     inspect_robotarm_programs: bool = arg(help='Inspect steps of robotarm programs')
     robotarm_send:             str  = arg(help='Send a raw program to the robot arm')
     robotarm_speed:            int  = arg(default=100, help='Robot arm speed [1-100]')
+    robotarm_standin:          int  = arg(help='Serve a stand-in for the robot arm controller on this port on localhost, such as 30001 for --simulator')
+    standin_time_scale:        float = arg(default=1.0, help='Scale the durations of the moves of the robot arm stand-in, such as 0.1 to run ten times faster')
+    standin_latency:           float = arg(help='Seconds the robot arm stand-in waits before sending each message')
+    standin_fail_rate:         float = arg(help='Probability that the robot arm stand-in fails a program partway by closing its connection')
+    standin_seed:              int | None = arg(default=None, help='Random seed for the failures of the robot arm stand-in (default: unseeded)')
+    asyncio:                   bool = arg(help='Run the threads of the program as asyncio tasks instead of OS threads')
+    store_events:              bool = arg(help='Import the log into the event store when the run finishes')
+    event_store:               str  = arg(default='cache/events.sqlite', help='SQLite file of the event store')
+    event_store_import:        str  = arg(help='Import a log, or the logs in a directory, into the event store')
+    event_store_query:         str  = arg(help='Run an SQL query on the event store and print the rows tab-separated')
     json_arg:                  str  = arg(help='Give arguments as json on the command line')
     yes:                       bool = arg(help='Assume yes in confirmation questions')
     make_uml:                  str  = arg(help='Write uml in dot format to the given path and exit')
@@ -115,10 +141,14 @@ def main_with_args(args: Args, parser: argparse.ArgumentParser | None=None):
     config = config.replace(
         robotarm_speed=args.robotarm_speed,
         log_filename=args.log_filename,
+        use_asyncio=args.asyncio,
+        event_store=args.event_store if args.store_events else None,
     )
 
     print('config =', show(config))
 
+    estimates.set_risk(args.risk)
+
     if args.force_update_protocol_dir or config.name == 'live':
         protocol_paths.update_protocol_dir(args.protocol_dir)
 
@@ -129,11 +159,14 @@ def main_with_args(args: Args, parser: argparse.ArgumentParser | None=None):
             cmdline0 = args.init_cmd_for_visualize
         else:
             cmdline0 = shlex.join(argv)
+        solve_timeout = args.solve_timeout
+        integer_time = args.integer_time
         def cmdline_to_log(cmdline: str):
             args, _ = arg.parse_args(Args, args=[cmdname, *shlex.split(cmdline)], exit_on_error=False)
+            estimates.set_risk(args.risk)
             p = args_to_program(args)
             assert p, 'no program from these arguments!'
-            return execute_program(config, p.program, {}, for_visualizer=True)
+            return execute_program(config, p.program, {}, for_visualizer=True, solve_timeout=solve_timeout, integer_time=integer_time)
         pv.start(cmdline0, cmdline_to_log)
 
     elif args.test_resume:
@@ -151,7 +184,7 @@ def main_with_args(args: Args, parser: argparse.ArgumentParser | None=None):
         log.write_jsonl(log_file2)
         run.write_jsonl(run_file)
         resume_time_now = log.zero_time() + timedelta(seconds=log[-1].t) + timedelta(seconds=args.test_resume_delay)
-        args2 = replace(args, test_resume='', resume=log_file2, resume_time_now=str(resume_time_now))
+        args2 = replace(args, test_resume='', resume=log_file2, resume_time_now=str(resume_time_now), resume_strict=True)
         main_with_args(args2, parser)
 
     elif args.resume:
@@ -161,12 +194,36 @@ def main_with_args(args: Args, parser: argparse.ArgumentParser | None=None):
             resume_time_now=args.resume_time_now or None,
             skip=utils.read_commasep(args.resume_skip),
             drop=utils.read_commasep(args.resume_drop),
+            strict=args.resume_strict,
+        )
+
+    elif args.sweep:
+        from . import sweep
+        points = sweep.sweep_points(
+            batch_sizes=args.sweep.split(),
+            incus=args.sweep_incu.split() or [args.incu],
         )
+        sweep.print_sweep(points, args.protocol_dir)
+
+    elif args.critical_path and (p := args_to_program(args)):
+        _, program, _ = schedule_program(p.program.remove_noops(), integer_time=args.integer_time)
+        for line in critical_path(program).report():
+            print(line)
+
+    elif args.robustness and (p := args_to_program(args)):
+        _, program, _ = schedule_program(p.program.remove_noops(), integer_time=args.integer_time)
+        for line in robustness(program).report():
+            print(line)
+
+    elif args.monte_carlo and (p := args_to_program(args)):
+        _, program, _ = schedule_program(p.program.remove_noops(), integer_time=args.integer_time)
+        for line in montecarlo(program, runs=args.monte_carlo).report():
+            print(line)
 
     elif p := args_to_program(args):
         if config.name != 'dry-run' and p.doc and not args.yes:
             ATTENTION(p.doc)
-        log = execute_program(config, p.program, p.metadata)
+        log = execute_program(config, p.program, p.metadata, integer_time=args.integer_time)
         if re.match('time.bioteks', p.metadata.get('program', '')) and config.name == 'live':
             estimates.add_estimates_from('estimates.json', log)
 
@@ -176,6 +233,28 @@ def main_with_args(args: Args, parser: argparse.ArgumentParser | None=None):
         arm.execute_moves([moves.RawCode(args.robotarm_send)], name='raw')
         arm.close()
 
+    elif args.event_store_import:
+        with contextlib.closing(EventStore(args.event_store)) as store:
+            for path, added in store.import_logs(args.event_store_import).items():
+                print(path, added, sep='\t')
+
+    elif args.event_store_query:
+        with contextlib.closing(EventStore(args.event_store)) as store:
+            columns, rows = store.query(args.event_store_query)
+            print(*columns, sep='\t')
+            for row in rows:
+                print(*row, sep='\t')
+
+    elif args.robotarm_standin:
+        RobotarmStandin(
+            port=args.robotarm_standin,
+            time_scale=args.standin_time_scale,
+            latency=args.standin_latency,
+            fail_rate=args.standin_fail_rate,
+            seed=args.standin_seed,
+            quiet=False,
+        ).serve_forever()
+
     elif args.list_robotarm_programs:
         for name in movelists.keys():
             print(name)
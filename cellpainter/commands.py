@@ -36,6 +36,7 @@ class Metadata:
 
     est:        float | None = None
     sleep_secs: float | None = None
+    slack:      float | None = None
 
     gui_force_show: bool = False
 
@@ -48,8 +49,9 @@ class Metadata:
         repl: dict[str, Any] = {}
         for other in others:
             repl.update(utils.nub(other))
-        out = replace(self, **repl)
-        return out
+        if not repl:
+            return self
+        return Metadata(**{**self.__dict__, **repl})
 
 class Command(abc.ABC):
     def required_resource(self) -> Literal['robotarm', 'incu', 'wash', 'disp'] | None:
@@ -36,20 +36,84 @@ def import_z3():
         print('=== import z3 end ===')
     sys.path = [*sys_path0]
 
-import_z3()
-
-from z3 import Sum, If, Optimize, Real, Int, Or # type: ignore
-
 from collections import defaultdict
 
+import threading
+import time
+from concurrent.futures import Future
+
 from . import estimates
 from .estimates import estimate
+from .schedule_cache import ScheduleCache, canonical_hash, default_cache
+from .difference_constraints import DifferenceSystem
 
-def optimize(cmd: Command) -> tuple[Command, dict[str, float]]:
-    cmd = cmd.make_resource_checkpoints()
-    opt = optimal_env(cmd)
+def optimize(cmd: Command, cache: ScheduleCache | None = default_cache, timeout: float | None = None, integer: bool = False, warm: WarmStart | None = None) -> tuple[Command, OptimalResult]:
+    '''
+    The program should already have its resource checkpoints, see Command.make_resource_checkpoints.
+
+    With a timeout the best schedule found in time is used. If it is not optimal
+    it is improved in the background and the optimal schedule ends up in the cache.
+
+    Warm started programs are resumed runs and are not cached.
+    '''
+    if warm is not None:
+        cache = None
+    try:
+        opt = cached_optimal_env(cmd, cache, timeout, integer, warm)
+    except ScheduleTimeout:
+        if cache is not None:
+            improve_in_background(cmd, cache, integer)
+        raise
+    if not opt.optimal and cache is not None:
+        improve_in_background(cmd, cache, integer)
     cmd = cmd.resolve(opt.env)
-    return cmd, opt.expected_ends
+    return cmd, opt
+
+def cached_optimal_env(cmd: Command, cache: ScheduleCache | None = default_cache, timeout: float | None = None, integer: bool = False, warm: WarmStart | None = None, decompose: bool = True) -> OptimalResult:
+    '''
+    Looks up the schedule in the cache before solving. z3 is only imported on a miss.
+    Only optimal schedules are cached.
+    '''
+    if cache is None:
+        return optimal_env(cmd, timeout, integer, warm, decompose)
+    key = canonical_hash(cmd, salt='integer' if integer else '')
+    if hit := cache.get(key):
+        return OptimalResult(
+            env=hit['env'],
+            expected_ends=hit['expected_ends'],
+            stats={'cache': 'hit', 'solve': hit['solve']},
+        )
+    opt = optimal_env(cmd, timeout, integer, decompose=decompose)
+    if not opt.optimal:
+        return replace(opt, stats={'cache': 'miss', **opt.stats})
+    cache.put(key, {
+        'env': opt.env,
+        'expected_ends': opt.expected_ends,
+        'solve': opt.stats['solve'],
+    })
+    return replace(opt, stats={'cache': 'miss', **opt.stats})
+
+background_lock = threading.Lock()
+
+def improve_in_background(cmd: Command, cache: ScheduleCache = default_cache, integer: bool = False) -> Future[OptimalResult]:
+    '''
+    Solves the whole program to optimality in a background thread and puts the
+    schedule in the cache. It is not decomposed since a stitched schedule that
+    is not proved optimal would come out the same. One program is solved at a
+    time. The threads are daemons so an unfinished solve does not keep the
+    program from exiting.
+    '''
+    future: Future[OptimalResult] = Future()
+    def improve():
+        with background_lock:
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(cached_optimal_env(cmd, cache, None, integer, decompose=False))
+            except BaseException as e:
+                future.set_exception(e)
+    threading.Thread(target=improve, name='optimize', daemon=True).start()
+    return future
 
 @dataclass(frozen=True)
 class Ids:
@@ -63,42 +127,110 @@ class Ids:
 class OptimalResult:
     env: dict[str, float]
     expected_ends: dict[str, float]
+    stats: dict[str, Any] = field(default_factory=dict[str, Any])
+    optimal: bool = True
+
+@dataclass(frozen=True)
+class WarmStart:
+    '''
+    Reschedules the rest of a resumed program: it starts at the current time,
+    the checkpoints that have already happened are fixed at their logged times
+    and the env of the previous schedule is the initial guess for z3.
+    '''
+    start: float
+    checkpoint_times: dict[str, float]
+    env: dict[str, float]
 
-def optimal_env(cmd: Command) -> OptimalResult:
+@dataclass(frozen=True)
+class Constraint:
+    lhs: Symbolic
+    op: Literal['>', '>=', '==']
+    rhs: Symbolic
+
+@dataclass(frozen=True)
+class MaxOf:
+    '''
+    max == Max(a, b)
+    '''
+    max: Symbolic
+    a: Symbolic
+    b: Symbolic
+
+@dataclass(frozen=True)
+class Model:
+    '''
+    The scheduling problem of a program.
+
+    Every point in time is a single variable plus an offset: a fresh time point
+    variable is introduced whenever a free variable is added to the current time.
+    The params are the free variables of the program and the duration variables,
+    everything else is a time point.
+
+    Each variable has a home: the batch index it is first mentioned in, or 0 outside
+    of batches. Each batch is first entered at a fresh time point, its entry.
+    Each variable also has a segment: the number of fresh time points introduced
+    before it was first mentioned. The cuts are the free variables added at each of
+    these time points.
+
+    The hint is an initial guess for the values of the variables.
+    '''
+    variables: set[str]
+    params: set[str]
+    constraints: list[Constraint]
+    maxes: list[MaxOf]
+    maximize: list[tuple[float, Symbolic]]
+    ends: dict[str, Symbolic]
+    homes: dict[str, int] = field(default_factory=dict[str, int])
+    entries: dict[int, str] = field(default_factory=dict[int, str])
+    segments: dict[str, int] = field(default_factory=dict[str, int])
+    cuts: list[set[str]] = field(default_factory=list[set[str]])
+    hint: dict[str, float] = field(default_factory=dict[str, float])
+
+def build_model(cmd: Command, warm: WarmStart | None = None) -> Model:
     variables = cmd.free_vars()
+    params = set(variables)
     ids = Ids()
 
-    Resolution = 2
+    constraints: list[Constraint] = []
+    maxes: list[MaxOf] = []
 
-    def to_expr(x: Symbolic | float | int | str) -> Any:
-        x = Symbolic.wrap(x)
-        s: Any = Sum(*[Real(v) for v in x.var_names]) # type: ignore
-        if x.offset:
-            offset = round(float(x.offset), Resolution)
-            return Sum(offset, s) # type: ignore
-        else:
-            return s
+    homes: dict[str, int] = {}
+    entries: dict[int, str] = {}
+    group = 0
+    segments: dict[str, int] = {}
+    cuts: list[set[str]] = []
 
-    s: Any = Optimize()
+    def mention(*xs: Symbolic):
+        for x in xs:
+            for v in x.var_names:
+                homes.setdefault(v, group)
+                segments.setdefault(v, len(cuts))
 
-    def Max(a: Symbolic | float | int, b: Symbolic | float | int):
+    def constrain(lhs: Symbolic | float | int | str, op: Literal['>', '>=', '=='], rhs: Symbolic | float | int | str):
+        if op not in ('>', '>=', '=='):
+            raise ValueError(f'{op=} not a valid operator')
+        c = Constraint(Symbolic.wrap(lhs), op, Symbolic.wrap(rhs))
+        mention(c.lhs, c.rhs)
+        constraints.append(c)
+
+    def Max(a: Symbolic, b: Symbolic):
         m = Symbolic.var(ids.assign('max'))
-        max_a_b, a, b = map(to_expr, (m, a, b))
-        s.add(max_a_b >= a)
-        s.add(max_a_b >= b)
-        s.add(Or(max_a_b == a, max_a_b == b))
+        mention(m, a, b)
+        maxes.append(MaxOf(m, a, b))
         return m
 
-    def constrain(lhs: Symbolic | float | int | str, op: Literal['>', '>=', '=='], rhs: Symbolic | float | int | str):
-        match op:
-            case '>':
-                s.add(to_expr(lhs) > to_expr(rhs))
-            case '>=':
-                s.add(to_expr(lhs) >= to_expr(rhs))
-            case '==':
-                s.add(to_expr(lhs) == to_expr(rhs))
-            case _:
-                raise ValueError(f'{op=} not a valid operator')
+    def after(begin: Symbolic, secs: Symbolic | float | int) -> Symbolic:
+        '''
+        The point in time secs after begin
+        '''
+        secs = Symbolic.wrap(secs)
+        if secs.var_names:
+            cuts.append(secs.var_set())
+            point = Symbolic.var(ids.assign('t'))
+            constrain(point, '==', begin + secs)
+            return point
+        else:
+            return begin + secs
 
     maximize_terms: list[tuple[float, Symbolic]] = []
     ends: dict[str, Symbolic] = {}
@@ -107,10 +239,11 @@ def optimal_env(cmd: Command) -> OptimalResult:
         '''
         returns end
         '''
+        nonlocal group
         match cmd:
             case Idle():
                 constrain(cmd.seconds, '>=', 0)
-                return begin + cmd.seconds
+                return after(begin, cmd.seconds)
             case Info():
                 return begin
             case RobotarmCmd():
@@ -124,12 +257,16 @@ def optimal_env(cmd: Command) -> OptimalResult:
                 constrain(begin, '==', checkpoint)
                 return begin
             case WaitForCheckpoint():
-                point = Symbolic.var(cmd.name) + cmd.plus_seconds
+                point = after(Symbolic.var(cmd.name), cmd.plus_seconds)
                 constrain(cmd.plus_seconds, '>=', 0)
-                if cmd.assume == 'will wait':
+                assume = cmd.assume
+                if warm and cmd.name in warm.checkpoint_times and assume == 'will wait':
+                    # after a pause the wait might already be over
+                    assume = 'nothing'
+                if assume == 'will wait':
                     constrain(point, '>=', begin)
                     return point
-                elif cmd.assume == 'no wait':
+                elif assume == 'no wait':
                     constrain(begin, '>=', point)
                     return begin
                 else:
@@ -140,9 +277,11 @@ def optimal_env(cmd: Command) -> OptimalResult:
                 checkpoint = Symbolic.var(cmd.name)
                 constrain(begin, '>=', checkpoint) # checkpoint must have happened
                 duration = Symbolic.var(ids.assign(cmd.name + ' duration '))
+                params.update(duration.var_names)
                 constrain(checkpoint + duration, '==', begin)
                 constrain(duration, '>=', 0)
-                if cmd.exactly is not None:
+                if cmd.exactly is not None and not (warm and cmd.name in warm.checkpoint_times):
+                    # a resumed duration that started before the pause cannot be exact
                     constrain(duration, '==', cmd.exactly)
                 if cmd.opt_weight:
                     maximize_terms.append((cmd.opt_weight, duration))
@@ -153,7 +292,16 @@ def optimal_env(cmd: Command) -> OptimalResult:
                     end = run(c, end, is_main=is_main)
                 return end
             case Meta():
+                outer = group
+                if (batch_index := cmd.metadata.batch_index) and batch_index != group:
+                    group = batch_index
+                    if group not in entries:
+                        entry = ids.assign('entry')
+                        entries[group] = entry
+                        constrain(entry, '==', begin)
+                        begin = Symbolic.var(entry)
                 end = run(cmd.command, begin, is_main=is_main)
+                group = outer
                 if cmd_id := cmd.metadata.id:
                     assert isinstance(cmd_id, str)
                     ends[cmd_id] = end
@@ -165,43 +313,777 @@ def optimal_env(cmd: Command) -> OptimalResult:
             case _:
                 raise ValueError(type(cmd))
 
-    run(cmd, Symbolic.const(0), is_main=True)
+    run(cmd, Symbolic.const(round(warm.start, Resolution) if warm else 0), is_main=True)
+
+    if warm:
+        for name, t in warm.checkpoint_times.items():
+            if name in homes:
+                constrain(name, '==', round(t, Resolution))
 
     # batch_sep = 180 # for specs jump
     # constrain('batch sep', '==', batch_sep * 60)
 
-    maximize = Sum(*[  # type: ignore
-        coeff * to_expr(v) for coeff, v in maximize_terms
-    ])
+    return Model(
+        variables=variables,
+        params=params,
+        constraints=constraints,
+        maxes=maxes,
+        maximize=maximize_terms,
+        ends=ends,
+        homes=homes,
+        entries=entries,
+        segments=segments,
+        cuts=cuts,
+        hint=warm.env if warm else {},
+    )
 
-    if isinstance(maximize, (int, float)):
-        pass
-    else:
-        s.maximize(maximize)
+Resolution = 2
+
+# Scale of the integer time mode
+Milliseconds = 1000
+
+def optimal_env(cmd: Command, timeout: float | None = None, integer: bool = False, warm: WarmStart | None = None, decompose: bool = True) -> OptimalResult:
+    '''
+    Solves the batches separately and stitches them together when possible,
+    otherwise the whole program at once. Warm started programs are solved at
+    once since their fixed checkpoints are not relative to the batch entries,
+    and so are programs with decompose=False.
+
+    With a timeout in seconds the best schedule found in time is returned,
+    marked as not optimal. The integer flag makes z3 use integer milliseconds.
+    '''
+    t0 = time.monotonic()
+    deadline = None if timeout is None else time.time() + timeout
+    model = build_model(cmd, warm)
+    res: OptimalResult | None = None
+    stitching: dict[str, Any] = {}
+    if len(model.entries) > 1 and warm is None and decompose:
+        parts = decompose_model(model)
+        try:
+            res = solve_decomposed(model, parts, integer, deadline)
+        except StitchingFailed as e:
+            stitching = {'stitching': repr(str(e))}
+    if res is None:
+        res = solve_model(model, remaining(deadline), integer)
+    solve = round(time.monotonic() - t0, 3)
+    return replace(res, stats={**res.stats, **stitching, 'solve': solve})
+
+def solve_model(model: Model, timeout: float | None = None, integer: bool = False) -> OptimalResult:
+    '''
+    Solves the difference constraints natively when possible, otherwise with z3.
+
+    A feasible but not optimal difference solution is kept as the best known
+    schedule in case z3 times out.
+    '''
+    seed: OptimalResult | None = None
+    try:
+        res = solve_difference(model)
+        if res.optimal:
+            return replace(res, stats={'engine': 'difference', **res.stats})
+        seed = replace(res, stats={'engine': 'difference', **res.stats})
+        reason = f'not optimal after {res.stats["rounds"]} rounds'
+    except NotDifferenceConstraints as e:
+        reason = str(e)
+    try:
+        res = solve_z3(model, timeout, integer)
+    except ScheduleTimeout:
+        if seed is None:
+            raise
+        return seed
+    if seed and not res.optimal and seed.stats['objective'] >= res.stats['objective']:
+        return seed
+    return replace(res, stats={'engine': 'z3', 'fallback': repr(reason), **res.stats})
+
+def remaining(deadline: float | None) -> float | None:
+    '''
+    The seconds left until a time.time() deadline. It is wall clock time so
+    that it means the same in the worker processes.
+    '''
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.time())
+
+def solve_until(model: Model, integer: bool = False, deadline: float | None = None) -> OptimalResult:
+    return solve_model(model, remaining(deadline), integer)
+
+class NotDifferenceConstraints(Exception):
+    pass
+
+Linear = tuple[dict[str, float], float]
+
+def linear(x: Symbolic) -> Linear:
+    coeffs: dict[str, float] = defaultdict(float)
+    for v in x.var_names:
+        coeffs[v] += 1
+    return coeffs, x.offset
+
+def linear_sub(x: Linear, y: Linear) -> Linear:
+    coeffs: dict[str, float] = defaultdict(float, x[0])
+    for v, c in y[0].items():
+        coeffs[v] -= c
+    return coeffs, x[1] - y[1]
+
+def solve_difference(model: Model, max_rounds: int | None = None) -> OptimalResult:
+    '''
+    Solves the model as a system of difference constraints between time points.
+
+    Each param is eliminated using an equation it occurs in and all constraints
+    must then be differences between two time points, otherwise NotDifferenceConstraints
+    is raised. The disjunctive maxes are relaxed to two lower bounds and fixed to one
+    of them until they are tight. The result is marked as not optimal if this does
+    not reach the objective value of the relaxation.
+
+    The objective value of the relaxation is an upper bound of the optimum and is
+    in stats['bound']. With max_rounds=1 only the relaxation is solved, which is
+    not a schedule unless it is marked optimal.
+    '''
+    rows: list[tuple[Linear, Literal['>', '>=', '==']]] = [
+        (linear_sub(linear(c.lhs), linear(c.rhs)), c.op)
+        for c in model.constraints
+    ]
+    for m in model.maxes:
+        for x in (m.a, m.b):
+            rows.append((linear_sub(linear(m.max), linear(x)), '>='))
+
+    definitions: dict[str, list[int]] = defaultdict(list)
+    for i, ((coeffs, _), op) in enumerate(rows):
+        if op == '==':
+            in_row = [v for v, c in coeffs.items() if c and v in model.params]
+            if len(in_row) == 1:
+                definitions[in_row[0]] += [i]
+
+    defs: dict[str, Linear] = {}
+    for p in sorted(model.params):
+        if not definitions[p]:
+            raise NotDifferenceConstraints(f'{p} is not defined by an equation')
+        i, *_ = definitions[p]
+        (coeffs, offset), _ = rows[i]
+        k = coeffs[p]
+        defs[p] = {v: -c / k for v, c in coeffs.items() if v != p}, -offset / k
+
+    def substitute(x: Linear) -> Linear:
+        coeffs: dict[str, float] = defaultdict(float)
+        offset = x[1]
+        for v, c in x[0].items():
+            if v in defs:
+                d_coeffs, d_offset = defs[v]
+                for dv, dc in d_coeffs.items():
+                    coeffs[dv] += c * dc
+                offset += c * d_offset
+            else:
+                coeffs[v] += c
+        return {v: c for v, c in coeffs.items() if abs(c) > 1e-9}, offset
+
+    def difference(row: Linear) -> tuple[str, str, float]:
+        '''
+        Returns u, v, w such that row >= 0 is t[v] - t[u] >= w
+        '''
+        coeffs, offset = substitute(row)
+        match sorted(coeffs.items(), key=lambda vc: -vc[1]):
+            case []:
+                return '', '', -offset
+            case [(p, 1.0)]:
+                return '', p, -offset
+            case [(q, -1.0)]:
+                return q, '', -offset
+            case [(p, 1.0), (q, -1.0)]:
+                return q, p, -offset
+            case _:
+                raise NotDifferenceConstraints(f'{row} is not a difference constraint')
+
+    edges: list[tuple[str, str, float, Literal['>', '>=', '==']]] = [
+        (*difference(row), op)
+        for row, op in rows
+    ]
+
+    objective: dict[str, float] = defaultdict(float)
+    for coeff, x in model.maximize:
+        for v, c in substitute(linear(x))[0].items():
+            objective[v] += coeff * c
+
+    t: dict[str, float] = {}
+
+    def value(x: Symbolic | Linear) -> float:
+        if isinstance(x, Symbolic):
+            x = linear(x)
+        coeffs, offset = substitute(x)
+        return sum(c * t[v] for v, c in coeffs.items()) + offset
+
+    # The maxes are first relaxed to their two lower bounds. Those that are not tight
+    # are fixed to the time of the waiting thread and the system is solved again.
+    # This restricts the max to one of its disjuncts, so the result is only optimal
+    # if it reaches the objective value of the relaxation.
+    fixed: set[int] = set()
+    bound: float | None = None
+    rounds = 0
+    while True:
+        rounds += 1
+        ds = DifferenceSystem()
+        for u, v, w, op in edges:
+            match op:
+                case '>=':
+                    ds.add(u, v, w)
+                case '==':
+                    ds.add_eq(u, v, w)
+                case _:
+                    raise NotDifferenceConstraints(f'{op=} is not supported')
+        for i in fixed:
+            m = model.maxes[i]
+            ds.add_eq(*difference(linear_sub(linear(m.max), linear(m.b))))
+        res = ds.maximize(objective)
+        if res is None:
+            raise NotDifferenceConstraints('infeasible or unbounded')
+        t = res
+        obj = sum(c * t[v] for v, c in objective.items())
+        if bound is None:
+            bound = obj
+        slack = {
+            i
+            for i, m in enumerate(model.maxes)
+            if abs(value(m.max) - max(value(m.a), value(m.b))) > 1e-6
+        }
+        if not slack or rounds == max_rounds:
+            break
+        fixed |= slack
+
+    optimal = not slack and obj >= bound - 1e-6 * max(1.0, abs(bound))
+
+    # the objective above leaves out the constant offsets, the bound includes them
+    # to be comparable with the objective of schedules solved in other ways
+    offset = sum(coeff * substitute(linear(x))[1] for coeff, x in model.maximize)
+
+    env = {
+        a: round(value(Symbolic.var(a)), Resolution)
+        for a in sorted(model.variables)
+    }
+
+    expected_ends = {
+        i: round(value(linear(e)), Resolution)
+        for i, e in model.ends.items()
+    }
+
+    stats = {'rounds': rounds, 'objective': round(obj, Resolution), 'bound': round(bound + offset, Resolution)}
+    return OptimalResult(env=env, expected_ends=expected_ends, stats=stats, optimal=optimal)
+
+@dataclass
+class Presolved:
+    '''
+    The model with its difference equalities eliminated, as linear rows lhs - rhs op 0.
+
+    Every eliminated variable is its representative plus an offset. The
+    representative '' is the constant zero.
+    '''
+    rows: list[tuple[Linear, Literal['>', '>=', '==']]]
+    maxes: list[tuple[Linear, Linear, Linear]]
+    objective: Linear
+    subst: dict[str, tuple[str, float]]
+    stats: dict[str, Any]
+
+    def substitute(self, x: Linear) -> Linear:
+        coeffs: dict[str, float] = defaultdict(float)
+        offset = x[1]
+        for v, c in x[0].items():
+            rep, d = self.subst.get(v, (v, 0.0))
+            if rep:
+                coeffs[rep] += c
+            offset += c * d
+        return {v: c for v, c in coeffs.items() if c}, offset
+
+def presolve(model: Model) -> Presolved:
+    '''
+    Union-finds the equalities x == y + c and x == c and substitutes them away,
+    merges repeated variables into coefficients and drops duplicate and trivial rows.
+    '''
+    rows: list[tuple[Linear, Literal['>', '>=', '==']]] = [
+        (linear_sub(linear(c.lhs), linear(c.rhs)), c.op)
+        for c in model.constraints
+    ]
+    maxes = [
+        (linear(m.max), linear(m.a), linear(m.b))
+        for m in model.maxes
+    ]
+
+    # v == parent[v] + delta[v]
+    parent: dict[str, str] = {}
+    delta: dict[str, float] = {}
+
+    def find(v: str) -> tuple[str, float]:
+        path: list[str] = []
+        d = 0.0
+        while v in parent:
+            path.append(v)
+            d += delta[v]
+            v = parent[v]
+        rest = d
+        for u in path:
+            rest, delta[u] = rest - delta[u], rest
+            parent[u] = v
+        return v, d
+
+    def unify(x: str, y: str, d: float) -> bool:
+        '''
+        x == y + d, returns False if they are already related
+        '''
+        (rx, ox), (ry, oy) = find(x), find(y)
+        if rx == ry:
+            return False
+        if rx == '':
+            rx, ox, ry, oy, d = ry, oy, rx, ox, -d
+        parent[rx] = ry
+        delta[rx] = oy + d - ox
+        return True
+
+    kept: list[tuple[Linear, Literal['>', '>=', '==']]] = []
+    for row, op in rows:
+        coeffs, offset = row
+        if op == '==':
+            match sorted([(v, c) for v, c in coeffs.items() if c], key=lambda vc: -vc[1]):
+                case [(x, 1.0)] if unify(x, '', -offset):
+                    continue
+                case [(x, -1.0)] if unify(x, '', offset):
+                    continue
+                case [(x, 1.0), (y, -1.0)] if unify(x, y, -offset):
+                    continue
+                case _:
+                    pass
+        kept.append((row, op))
+
+    variables = {
+        v
+        for row, _ in rows
+        for v in row[0]
+    } | {
+        v
+        for m in maxes
+        for x in m
+        for v in x[0]
+    }
+
+    out = Presolved(
+        rows=[],
+        maxes=[],
+        objective=({}, 0.0),
+        subst={v: find(v) for v in variables},
+        stats={},
+    )
+
+    seen: set[Any] = set()
+    for row, op in kept:
+        coeffs, offset = out.substitute(row)
+        if not coeffs and {'>': offset > 0, '>=': offset >= 0, '==': offset == 0}[op]:
+            continue
+        key = (tuple(sorted(coeffs.items())), offset, op)
+        if key in seen:
+            continue
+        seen.add(key)
+        out.rows.append(((coeffs, offset), op))
+
+    out.maxes = [
+        (out.substitute(m), out.substitute(a), out.substitute(b))
+        for m, a, b in maxes
+    ]
+
+    objective: dict[str, float] = defaultdict(float)
+    for coeff, x in model.maximize:
+        for v, c in out.substitute(linear(x))[0].items():
+            objective[v] += coeff * c
+    out.objective = {v: c for v, c in objective.items() if c}, 0.0
+
+    remaining = {
+        v
+        for row, _ in out.rows
+        for v in row[0]
+    } | {
+        v
+        for m in out.maxes
+        for x in m
+        for v in x[0]
+    }
+    out.stats = {
+        'vars': f'{len(variables)}->{len(remaining)}',
+        'constraints': f'{len(rows) + 3 * len(maxes)}->{len(out.rows) + 3 * len(out.maxes)}',
+    }
+    return out
+
+class ScheduleTimeout(Exception):
+    pass
+
+def solve_z3(model: Model, timeout: float | None = None, integer: bool = False) -> OptimalResult:
+    '''
+    If z3 times out the best model found so far is used, marked as not optimal.
+    Raises ScheduleTimeout if there is none.
+
+    In integer mode all offsets are scaled to whole milliseconds and the
+    model is built over Int, which z3 solves with integer difference logic.
+    '''
+    import_z3()
+    from z3 import Sum, Optimize, Real, RealVal, Int, IntVal, Or, Z3Exception, is_true # type: ignore
+
+    pre = presolve(model)
+
+    scale = Milliseconds if integer else 1
+    consts: dict[str, Any] = {}
+
+    def const(v: str) -> Any:
+        if v not in consts:
+            consts[v] = Int(v) if integer else Real(v)
+        return consts[v]
+
+    def to_expr(x: Linear) -> Any:
+        coeffs, offset = x
+        terms: list[Any] = []
+        for v, c in sorted(coeffs.items()):
+            if integer:
+                c = int(c)
+            terms.append(const(v) if c == 1 else c * const(v))
+        if integer:
+            offset = round(float(offset) * scale)
+            if offset or not terms:
+                terms.append(IntVal(offset))
+        else:
+            offset = round(float(offset), Resolution)
+            if offset or not terms:
+                terms.append(RealVal(offset))
+        return Sum(*terms) if len(terms) > 1 else terms[0] # type: ignore
+
+    s: Any = Optimize()
+
+    for row, op in pre.rows:
+        e = to_expr(row)
+        match op:
+            case '>':
+                s.add(e > 0)
+            case '>=':
+                s.add(e >= 0)
+            case '==':
+                s.add(e == 0)
+
+    for m in pre.maxes:
+        max_a_b, a, b = map(to_expr, m)
+        s.add(max_a_b >= a)
+        s.add(max_a_b >= b)
+        s.add(Or(max_a_b == a, max_a_b == b))
+
+    if pre.objective[0]:
+        # in integer mode the weights are scaled too to keep the objective integral
+        s.maximize(to_expr(({v: round(c * scale) for v, c in pre.objective[0].items()}, 0.0)))
+
+    for v, x in model.hint.items():
+        coeffs, offset = pre.substitute(linear(Symbolic.var(v)))
+        if len(coeffs) == 1 and (rep := next(iter(coeffs))) in consts and coeffs[rep] == 1:
+            x = x - offset
+            s.set_initial_value(consts[rep], IntVal(round(x * scale)) if integer else RealVal(round(x, Resolution)))
+
+    if timeout is not None:
+        s.set(timeout=max(1, int(timeout * 1000)))
 
     # print(s)
     check = str(s.check())
-    assert check == 'sat', f'Impossible to schedule! (Number of missing time estimates: {len(estimates.guesses)}: {", ".join(str(g) for g in estimates.guesses.keys())}'
+    optimal = check == 'sat'
+    if check == 'unknown' and timeout is not None:
+        try:
+            M = s.model()
+        except Z3Exception:
+            M = None
+        # the model of an interrupted search need not satisfy all constraints
+        if M is None or not all(is_true(M.eval(c, model_completion=True)) for c in s.assertions()):
+            raise ScheduleTimeout(f'No schedule found in {timeout}s')
+    else:
+        assert check == 'sat', f'Impossible to schedule! (Number of missing time estimates: {len(estimates.guesses)}: {", ".join(str(g) for g in estimates.guesses.keys())}'
+        M = s.model()
 
-    M = s.model()
+    values: dict[str, float] = {}
+    for v, x in consts.items():
+        x = M.eval(x, model_completion=True)
+        values[v] = x.as_long() / scale if integer else float(x.as_fraction())
 
-    def model_value(a: Symbolic | str) -> float:
-        s = Symbolic.wrap(a)
-        e = to_expr(s)
-        if isinstance(e, (float, int)):
-            return float(e)
-        else:
-            # as_decimal result looks like '12.345?'
-            return float(M.eval(e).as_decimal(Resolution).strip('?'))
+    def value(x: Linear) -> float:
+        coeffs, offset = x
+        return sum(c * values.get(v, 0.0) for v, c in coeffs.items()) + offset
+
+    def model_value(x: Symbolic | str) -> float:
+        return round(value(pre.substitute(linear(Symbolic.wrap(x)))), Resolution)
 
     env = {
         a: model_value(a)
-        for a in sorted(variables)
+        for a in sorted(model.variables)
     }
 
     expected_ends = {
         i: model_value(e)
-        for i, e in ends.items()
+        for i, e in model.ends.items()
+    }
+
+    stats = {**pre.stats, 'objective': round(value(pre.objective), Resolution)}
+    return OptimalResult(env=env, expected_ends=expected_ends, stats=stats, optimal=optimal)
+
+class StitchingFailed(Exception):
+    pass
+
+@dataclass(frozen=True)
+class Decomposition:
+    '''
+    One model per batch (and one for the part outside of batches, index 0).
+
+    The batch models only have the constraints local to the batch and are
+    anchored at their entry point. The batches are then stitched together
+    by moving rigid bodies of time points: a batch is split into bodies at
+    the time points that wait for an interface param. The anchors map each
+    time point in a batch to the first time point of its body.
+    '''
+    components: dict[int, Model]
+    interface: set[str]
+    anchors: dict[str, str]
+
+def decompose_model(model: Model) -> Decomposition:
+    homes = model.homes
+    interface: set[str] = set()
+
+    def var_set(*xs: Symbolic) -> set[str]:
+        return {v for x in xs for v in x.var_names}
+
+    def home(vs: set[str]) -> int | None:
+        '''
+        The batch of a constraint over these variables, None if it is a cross constraint.
+        '''
+        gs = {homes[v] for v in vs}
+        if len(gs) > 1 or vs & interface:
+            return None
+        return next(iter(gs), 0)
+
+    # params in cross constraints are interface params, which makes more cross constraints
+    while True:
+        grow = {
+            v
+            for xs in [
+                *[(c.lhs, c.rhs) for c in model.constraints],
+                *[(m.max, m.a, m.b) for m in model.maxes],
+            ]
+            if home(vs := var_set(*xs)) is None
+            for v in vs
+            if v in model.params
+        }
+        if grow <= interface:
+            break
+        interface |= grow
+
+    groups = {0, *homes.values()}
+    constraints: dict[int, list[Constraint]] = {g: [] for g in groups}
+    maxes: dict[int, list[MaxOf]] = {g: [] for g in groups}
+    maximize: dict[int, list[tuple[float, Symbolic]]] = {g: [] for g in groups}
+
+    for c in model.constraints:
+        g = home(var_set(c.lhs, c.rhs))
+        if g is not None:
+            constraints[g] += [c]
+
+    for m in model.maxes:
+        g = home(var_set(m.max, m.a, m.b))
+        if g is not None:
+            maxes[g] += [m]
+        else:
+            # the local arguments are still lower bounds in the batch
+            for x in (m.a, m.b):
+                if (g := home(var_set(m.max, x))) is not None:
+                    constraints[g] += [Constraint(m.max, '>=', x)]
+
+    for coeff, x in model.maximize:
+        g = home(var_set(x))
+        if g is not None:
+            maximize[g] += [(coeff, x)]
+
+    for g, entry in model.entries.items():
+        constraints[g] += [Constraint(Symbolic.var(entry), '==', Symbolic.const(0))]
+
+    components = {
+        g: Model(
+            variables=var_set(
+                *[x for c in constraints[g] for x in (c.lhs, c.rhs)],
+                *[x for m in maxes[g] for x in (m.max, m.a, m.b)],
+            ),
+            params={v for v in model.params if homes.get(v) == g} - interface,
+            constraints=constraints[g],
+            maxes=maxes[g],
+            maximize=maximize[g],
+            ends={},
+        )
+        for g in sorted(groups)
+        if constraints[g] or maxes[g]
     }
 
-    return OptimalResult(env=env, expected_ends=expected_ends)
+    body: list[int] = []
+    for i, cut in enumerate([set[str](), *model.cuts]):
+        body += [i if cut & interface or not body else body[-1]]
+
+    anchors: dict[str, str] = {}
+    firsts: dict[tuple[int, int], str] = {}
+    for v, g in homes.items():
+        if g and v not in model.params:
+            anchors[v] = firsts.setdefault((g, body[model.segments[v]]), v)
+
+    return Decomposition(
+        components=components,
+        interface=interface,
+        anchors=anchors,
+    )
+
+def solve_decomposed(model: Model, parts: Decomposition, integer: bool = False, deadline: float | None = None) -> OptimalResult:
+    '''
+    Solves the batches in parallel processes and then places their bodies in time
+    by solving the constraints between bodies over the anchors and interface params.
+
+    The stitched schedule is checked against all constraints of the model and
+    StitchingFailed is raised if it is not a solution.
+
+    The batches and the stitching share the time until the deadline. The result
+    is not optimal if any of them was stopped by it.
+
+    Optimal batches stitched optimally need not make an optimal schedule, so the
+    result is only marked optimal if its objective reaches the upper bound from
+    the relaxation of the whole model, see solve_difference.
+    '''
+    from concurrent.futures import ProcessPoolExecutor
+    from functools import partial
+    import os
+
+    with ProcessPoolExecutor(max_workers=min(len(parts.components), os.cpu_count() or 1)) as pool:
+        results = list(pool.map(partial(solve_until, integer=integer, deadline=deadline), parts.components.values()))
+
+    local: dict[str, float] = defaultdict(float)
+    for res in results:
+        local |= res.env
+
+    def substitute(x: Symbolic) -> Linear:
+        '''
+        Anchors and interface params are variables, the rest are their local values
+        '''
+        coeffs: dict[str, float] = defaultdict(float)
+        offset = x.offset
+        for v in x.var_names:
+            if v in parts.interface:
+                coeffs[v] += 1
+            elif anchor := parts.anchors.get(v):
+                coeffs[anchor] += 1
+                offset += local[v] - local[anchor]
+            else:
+                offset += local[v]
+        return {v: c for v, c in coeffs.items() if c}, offset
+
+    def rigid(x: Symbolic, y: Symbolic) -> bool:
+        '''
+        Whether the local values satisfy a relation between x and y wherever the body is placed
+        '''
+        coeffs, _ = linear_sub(substitute(x), substitute(y))
+        anchors = {parts.anchors.get(v) for v in x.var_names + y.var_names} - {None}
+        return len(anchors) <= 1 and not any(coeffs.values()) and not (x.var_set() | y.var_set()) & parts.interface
+
+    def to_symbolic(x: Linear, lift: float = 0.0) -> Symbolic:
+        coeffs, offset = x
+        var_names: list[str] = []
+        for v, c in coeffs.items():
+            if c < 0 or c != round(c):
+                raise StitchingFailed(f'{c} * {v} cannot be stitched')
+            var_names += [v] * int(c)
+        return Symbolic(var_names, float(offset + lift))
+
+    def to_constraint(lhs: Linear, op: Literal['>', '>=', '=='], rhs: Linear) -> Constraint:
+        coeffs, offset = linear_sub(lhs, rhs)
+        pos = {v: c for v, c in coeffs.items() if c > 0}, max(offset, 0.0)
+        neg = {v: -c for v, c in coeffs.items() if c < 0}, max(-offset, 0.0)
+        return Constraint(to_symbolic(pos), op, to_symbolic(neg))
+
+    constraints = [
+        to_constraint(substitute(c.lhs), c.op, substitute(c.rhs))
+        for c in model.constraints
+        if not rigid(c.lhs, c.rhs)
+    ]
+
+    maxes: list[MaxOf] = []
+    for m in model.maxes:
+        if rigid(m.max, m.a) and rigid(m.max, m.b):
+            continue
+        mx, a, b = map(substitute, (m.max, m.a, m.b))
+        tight = any(
+            abs(m.max.resolve(local) - x.resolve(local)) < 10 ** -Resolution
+            for x in (m.a, m.b)
+            if rigid(m.max, x)
+        )
+        if tight:
+            # the max is attained within the body, the other argument just has to be below it
+            constraints += [to_constraint(mx, '>=', a), to_constraint(mx, '>=', b)]
+        else:
+            lift = max(0.0, *(-x[1] for x in (mx, a, b)))
+            maxes += [MaxOf(*(to_symbolic(x, lift) for x in (mx, a, b)))]
+
+    maximize = [
+        (coeff, to_symbolic((coeffs, 0.0)))
+        for coeff, x in model.maximize
+        for coeffs, _ in [substitute(x)]
+        if coeffs
+    ]
+
+    stitch = Model(
+        variables={*parts.anchors.values(), *parts.interface},
+        params=set(parts.interface),
+        constraints=constraints,
+        maxes=maxes,
+        maximize=maximize,
+        ends={},
+    )
+
+    try:
+        stitched = solve_model(stitch, remaining(deadline), integer)
+    except AssertionError as e:
+        raise StitchingFailed(str(e))
+
+    values: dict[str, float] = {}
+    for v in model.homes:
+        if v in parts.interface:
+            values[v] = stitched.env[v]
+        elif anchor := parts.anchors.get(v):
+            values[v] = local[v] - local[anchor] + stitched.env[anchor]
+        else:
+            values[v] = local[v]
+
+    tol = 0.05
+    for c in model.constraints:
+        lhs, rhs = c.lhs.resolve(values), c.rhs.resolve(values)
+        ok = {'>': lhs > rhs - tol, '>=': lhs >= rhs - tol, '==': abs(lhs - rhs) < tol}[c.op]
+        if not ok:
+            raise StitchingFailed(f'{c} not satisfied')
+    for m in model.maxes:
+        if abs(m.max.resolve(values) - max(m.a.resolve(values), m.b.resolve(values))) >= tol:
+            raise StitchingFailed(f'{m} not satisfied')
+
+    env = {
+        a: round(values[a], Resolution)
+        for a in sorted(model.variables)
+    }
+
+    expected_ends = {
+        i: round(e.resolve(values), Resolution)
+        for i, e in model.ends.items()
+    }
+
+    objective = sum(coeff * x.resolve(values) for coeff, x in model.maximize)
+    try:
+        bound = solve_difference(model, max_rounds=1).stats['bound']
+    except NotDifferenceConstraints:
+        bound = None
+
+    optimal = (
+        stitched.optimal
+        and all(res.optimal for res in results)
+        and bound is not None
+        and objective >= bound - tol * sum(abs(coeff) for coeff, _ in model.maximize)
+    )
+
+    stats = {
+        'engine': 'stitched',
+        'components': len(parts.components),
+        'bodies': len(set(parts.anchors.values())),
+        'stitch': stitched.stats['engine'],
+        'objective': round(objective, Resolution),
+        'bound': bound,
+    }
+    return OptimalResult(env=env, expected_ends=expected_ends, stats=stats, optimal=optimal)
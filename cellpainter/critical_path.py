@@ -0,0 +1,235 @@
+'''
+Critical path and slack of a resolved program
+
+The program is read as a graph with the same semantics as execute: each
+command starts when the previous command in its thread has finished and waits
+start at the latest of that and their checkpoint plus the scheduled delay.
+The commands are timed by their estimates.
+
+The slack of a command is how much later it can finish without making the
+program finish later. The commands without slack are critical and the
+critical path is the chain of them that ends last.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+from . import utils
+from .commands import (
+    Command,
+    Metadata,
+    Seq,
+    Fork,
+    Meta,
+    Checkpoint,
+    Duration,
+    Idle,
+    Info,
+    WaitForCheckpoint,
+)
+from .estimates import estimate, EstCmd
+
+# Slack below this many seconds is considered critical
+Tolerance = 0.01
+
+@dataclass(frozen=True)
+class Node:
+    cmd: Command
+    metadata: Metadata
+    start: float
+    end: float
+    slack: float
+
+    @property
+    def critical(self):
+        return self.slack < Tolerance
+
+@dataclass(frozen=True)
+class CriticalPath:
+    nodes: list[Node]
+    makespan: float
+    path: list[Node]
+
+    def slack(self) -> dict[str, float]:
+        '''
+        The slack of each command by id
+        '''
+        return {
+            n.metadata.id: n.slack
+            for n in self.nodes
+            if n.metadata.id
+        }
+
+    def critical_time(self) -> dict[str, float]:
+        '''
+        The time each estimate takes up of the critical path. These are the
+        estimates that are worth timing carefully and the moves worth speeding up.
+        '''
+        out: dict[str, float] = {}
+        for n in self.path:
+            if isinstance(n.cmd, EstCmd):
+                k = str(n.cmd)
+                out[k] = round(out.get(k, 0.0) + n.end - n.start, 3)
+        return out
+
+    def report(self) -> list[str]:
+        lines = [f'makespan: {utils.pp_secs(self.makespan)}', 'critical path:']
+        for n in self.path:
+            if n.end > n.start or isinstance(n.cmd, WaitForCheckpoint):
+                desc = ' '.join(str(x) for x in [n.metadata.plate_id and f'plate {n.metadata.plate_id}', n.metadata.step, n.metadata.substep] if x)
+                lines += [f'  {utils.pp_secs(n.start):>8} {n.end - n.start:8.1f}s  {n.cmd}  {desc}'.rstrip()]
+        lines += ['critical time per estimate:']
+        for k, secs in sorted(self.critical_time().items(), key=lambda kv: -kv[1]):
+            lines += [f'  {secs:8.1f}s  {k}']
+        return lines
+
+def duration(cmd: Command) -> float:
+    match cmd:
+        case Idle():
+            secs = cmd.secs
+            assert isinstance(secs, (float, int)), 'resolve the program first'
+            return float(secs)
+        case _ if isinstance(cmd, EstCmd):
+            return estimate(cmd)
+        case _:
+            return 0.0
+
+@dataclass(frozen=True)
+class Graph:
+    '''
+    The commands of a program in execution order, each with its predecessors
+    and the delay after them.
+    '''
+    cmds: list[tuple[Command, Metadata]]
+    preds: list[list[tuple[int, float]]]
+    succs: list[list[tuple[int, float]]]
+    order: list[int]
+    checkpoints: dict[str, int]
+
+    def durations(self) -> list[float]:
+        return [duration(cmd) for cmd, _ in self.cmds]
+
+    def times(self, durations: list[float]) -> tuple[list[float], list[float]]:
+        '''
+        The start and end time of each command
+        '''
+        start: list[float] = [0.0] * len(self.cmds)
+        end: list[float] = [0.0] * len(self.cmds)
+        for i in self.order:
+            start[i] = max((end[j] + delay for j, delay in self.preds[i]), default=0.0)
+            end[i] = start[i] + durations[i]
+        return start, end
+
+def graph(program: Command) -> Graph:
+    cmds: list[tuple[Command, Metadata]] = []
+    preds: list[list[tuple[int, float]]] = []
+
+    # waits on checkpoints, resolved when all checkpoints are known
+    waits: list[tuple[int, str, float]] = []
+    checkpoints: dict[str, int] = {}
+
+    def add(cmd: Command, metadata: Metadata, prev: int | None) -> int:
+        i = len(cmds)
+        cmds.append((cmd, metadata))
+        preds.append([] if prev is None else [(prev, 0.0)])
+        return i
+
+    def run(cmd: Command, metadata: Metadata, prev: int | None) -> int | None:
+        '''
+        returns the index of the last command
+        '''
+        match cmd:
+            case Meta():
+                return run(cmd.command, metadata.merge(cmd.metadata), prev)
+            case Seq():
+                for c in cmd.commands:
+                    prev = run(c, metadata, prev)
+                return prev
+            case Fork():
+                fork_metadata = metadata.merge(Metadata(thread_name=cmd.thread_name, thread_resource=cmd.resource))
+                run(cmd.command, fork_metadata, prev)
+                return prev
+            case Checkpoint():
+                i = add(cmd, metadata, prev)
+                checkpoints[cmd.name] = i
+                return i
+            case WaitForCheckpoint():
+                plus_secs = cmd.plus_secs
+                assert isinstance(plus_secs, (float, int)), 'resolve the program first'
+                i = add(cmd, metadata, prev)
+                waits.append((i, cmd.name, float(plus_secs)))
+                return i
+            case Duration():
+                i = add(cmd, metadata, prev)
+                waits.append((i, cmd.name, 0.0))
+                return i
+            case Info():
+                return prev
+            case _:
+                return add(cmd, metadata, prev)
+
+    run(program, Metadata(), None)
+
+    for i, name, plus_secs in waits:
+        preds[i].append((checkpoints[name], plus_secs))
+
+    succs: list[list[tuple[int, float]]] = [[] for _ in cmds]
+    indegree = [len(p) for p in preds]
+    for i, ps in enumerate(preds):
+        for j, delay in ps:
+            succs[j].append((i, delay))
+
+    order: list[int] = [i for i, d in enumerate(indegree) if d == 0]
+    for i in order:
+        for j, _ in succs[i]:
+            indegree[j] -= 1
+            if indegree[j] == 0:
+                order.append(j)
+    assert len(order) == len(cmds), 'the program waits for checkpoints in a cycle'
+
+    return Graph(cmds=cmds, preds=preds, succs=succs, order=order, checkpoints=checkpoints)
+
+def critical_path(program: Command) -> CriticalPath:
+    g = graph(program)
+    durations = g.durations()
+    start, end = g.times(durations)
+
+    makespan = max(end, default=0.0)
+
+    latest_end: list[float] = [makespan] * len(g.cmds)
+    for i in reversed(g.order):
+        latest_end[i] = min(
+            (latest_end[j] - durations[j] - delay for j, delay in g.succs[i]),
+            default=makespan,
+        )
+
+    nodes = [
+        Node(
+            cmd=cmd,
+            metadata=metadata,
+            start=round(start[i], 3),
+            end=round(end[i], 3),
+            slack=round(latest_end[i] - end[i], 3),
+        )
+        for i, (cmd, metadata) in enumerate(g.cmds)
+    ]
+
+    path: list[int] = []
+    if nodes:
+        i = max(range(len(nodes)), key=lambda i: end[i])
+        while True:
+            path.append(i)
+            tight = [
+                j
+                for j, delay in g.preds[i]
+                if abs(end[j] + delay - start[i]) < Tolerance
+            ]
+            if not tight:
+                break
+            i = tight[0]
+
+    return CriticalPath(
+        nodes=nodes,
+        makespan=round(makespan, 3),
+        path=[nodes[i] for i in reversed(path)],
+    )
@@ -0,0 +1,190 @@
+'''
+Systems of difference constraints t[v] - t[u] >= w
+
+Feasibility and the earliest schedule are longest paths from the root.
+A linear objective over the time points is maximized by solving the dual,
+which is a min-cost flow problem, with successive shortest paths.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+from collections import defaultdict, deque
+import heapq
+
+inf = float('inf')
+eps = 1e-9
+
+@dataclass
+class DifferenceSystem:
+    '''
+    Constraints of the form t[v] - t[u] >= w between named time points.
+    '''
+    root: str = ''
+    edges: list[tuple[str, str, float]] = field(default_factory=list[tuple[str, str, float]])
+
+    def add(self, u: str, v: str, w: float):
+        '''
+        t[v] - t[u] >= w
+        '''
+        self.edges.append((u, v, w))
+
+    def add_eq(self, u: str, v: str, w: float):
+        '''
+        t[v] - t[u] == w
+        '''
+        self.add(u, v, w)
+        self.add(v, u, -w)
+
+    def nodes(self) -> list[str]:
+        seen: dict[str, None] = {self.root: None}
+        for u, v, _ in self.edges:
+            seen[u] = None
+            seen[v] = None
+        return list(seen.keys())
+
+    def longest_paths(self) -> dict[str, float] | None:
+        '''
+        The earliest times satisfying all constraints with t[root] = 0.
+
+        Returns None if there is a positive cycle (the system is infeasible)
+        or if some time point is not reachable from the root.
+        '''
+        nodes = self.nodes()
+        out: dict[str, list[tuple[str, float]]] = defaultdict(list)
+        for u, v, w in self.edges:
+            out[u].append((v, w))
+        t: dict[str, float] = {self.root: 0.0}
+        relaxations: dict[str, int] = defaultdict(int)
+        queue: deque[str] = deque([self.root])
+        queued = {self.root}
+        while queue:
+            u = queue.popleft()
+            queued.discard(u)
+            tu = t[u]
+            for v, w in out[u]:
+                if tu + w > t.get(v, -inf) + eps:
+                    t[v] = tu + w
+                    relaxations[v] += 1
+                    if relaxations[v] > len(nodes):
+                        return None
+                    if v not in queued:
+                        queued.add(v)
+                        queue.append(v)
+        if len(t) != len(nodes):
+            return None
+        return t
+
+    def maximize(self, objective: dict[str, float]) -> dict[str, float] | None:
+        '''
+        Times maximizing sum(c * t[k] for k, c in objective.items()) with t[root] = 0.
+
+        Among the optimal solutions the earliest one is returned.
+        Returns None if the system is infeasible or the objective is unbounded.
+        '''
+        t0 = self.longest_paths()
+        if t0 is None:
+            return None
+        objective = {k: c for k, c in objective.items() if k != self.root and abs(c) > eps}
+        if not objective:
+            return t0
+
+        nodes = self.nodes()
+        index = {v: i for i, v in enumerate(nodes)}
+        N = len(nodes)
+
+        # Residual graph of the dual: one arc per constraint u -> v with cost -w and
+        # unbounded capacity, and its reverse arc with cost w and capacity equal to the flow.
+        head: list[int] = []
+        cost: list[float] = []
+        cap: list[float] = []
+        adj: list[list[int]] = [[] for _ in range(N)]
+        for u, v, w in self.edges:
+            iu, iv = index[u], index[v]
+            adj[iu].append(len(head))
+            head.append(iv)
+            cost.append(-w)
+            cap.append(inf)
+            adj[iv].append(len(head))
+            head.append(iu)
+            cost.append(w)
+            cap.append(0.0)
+
+        # The dual flow must satisfy inflow - outflow = -c at each node except the root.
+        excess = [0.0] * N
+        for k, c in objective.items():
+            excess[index[k]] += c
+        excess[index[self.root]] -= sum(excess)
+
+        # Potentials: a feasible primal schedule gives nonnegative reduced costs.
+        pot = [-t0[v] for v in nodes]
+
+        for s in range(N):
+            while excess[s] > eps:
+                dist: dict[int, float] = {s: 0.0}
+                prev: dict[int, int] = {}
+                done: list[int] = []
+                heap = [(0.0, s)]
+                sink = -1
+                while heap:
+                    d, u = heapq.heappop(heap)
+                    if d > dist[u]:
+                        continue
+                    done.append(u)
+                    if excess[u] < -eps:
+                        sink = u
+                        break
+                    pu = pot[u]
+                    for a in adj[u]:
+                        if cap[a] <= eps:
+                            continue
+                        v = head[a]
+                        nd = d + cost[a] + pu - pot[v]
+                        if nd < dist.get(v, inf) - eps:
+                            dist[v] = nd
+                            prev[v] = a
+                            heapq.heappush(heap, (nd, v))
+                if sink == -1:
+                    return None
+                D = dist[sink]
+                for u in done:
+                    pot[u] += dist[u] - D
+                amount = min(excess[s], -excess[sink])
+                v = sink
+                while v != s:
+                    a = prev[v]
+                    amount = min(amount, cap[a])
+                    v = head[a ^ 1]
+                v = sink
+                while v != s:
+                    a = prev[v]
+                    cap[a] -= amount
+                    cap[a ^ 1] += amount
+                    v = head[a ^ 1]
+                excess[s] -= amount
+                excess[sink] += amount
+
+        # t = -pot is optimal. Move to the earliest optimal solution by taking longest
+        # paths over the constraints that are tight with respect to the dual flow.
+        t = [-p for p in pot]
+        dist2 = [inf] * N
+        r = index[self.root]
+        dist2[r] = 0.0
+        heap2 = [(0.0, r)]
+        while heap2:
+            d, u = heapq.heappop(heap2)
+            if d > dist2[u]:
+                continue
+            for a in adj[u]:
+                if cap[a] <= eps:
+                    continue
+                v = head[a]
+                # reduced cost of the arc is nonnegative since t is optimal
+                nd = d + max(0.0, cost[a] + t[v] - t[u])
+                if nd < dist2[v] - eps:
+                    dist2[v] = nd
+                    heapq.heappush(heap2, (nd, v))
+        return {
+            v: t[i] - t[r] - dist2[i]
+            for v, i in index.items()
+        }
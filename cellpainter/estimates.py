@@ -3,14 +3,18 @@ from dataclasses import *
 from typing import *
 
 from . import utils
-from .log import Log
+from .log import Log, LogEntry
+from .symbolic import Symbolic
 
 from collections import defaultdict
+from functools import cache
+import math
 
 from .commands import (
     RobotarmCmd,
     IncuCmd,
     BiotekCmd,
+    Duration,
 )
 
 EstCmd = RobotarmCmd | IncuCmd | BiotekCmd
@@ -29,13 +33,39 @@ def avg(xs: Iterable[float]) -> float:
     xs = list(xs)
     return sum(xs) / len(xs)
 
-def estimates_from(path: str) -> dict[EstCmd, float]:
+def percentile(xs: Iterable[float], p: float) -> float:
+    '''
+    The p:th percentile (0 to 100) interpolated between the closest ranks
+    '''
+    xs = sorted(xs)
+    k = (len(xs) - 1) * p / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return xs[lo] + (xs[hi] - xs[lo]) * (k - lo)
+
+def timings_from(path: str) -> dict[EstCmd, list[float]]:
     entries: list[EstEntry] = cast(Any, utils.serializer.read_json(path))
     return {
-        e['cmd']: round(avg(e['times'].values()), 3)
+        e['cmd']: list(e['times'].values())
         for e in entries
     }
 
+def estimates_of(timings: dict[EstCmd, list[float]], risk: float | None = None) -> dict[EstCmd, float]:
+    '''
+    The average of the timings. With a risk percentile the estimate is instead
+    that percentile of the timings when it is above the average, so that the
+    spread of the timings is a buffer in the schedule.
+    '''
+    return {
+        cmd: round(
+            max(avg(times), percentile(times, risk)) if risk else avg(times),
+            3,
+        )
+        for cmd, times in timings.items()
+    }
+
+def estimates_from(path: str, risk: float | None = None) -> dict[EstCmd, float]:
+    return estimates_of(timings_from(path), risk)
+
 def add_estimates_from(path: str, log_or_log_path: str | Log):
     entries: list[EstEntry] = cast(Any, utils.serializer.read_json(path))
     ests: dict[EstCmd, dict[str, float]] = defaultdict(dict)
@@ -60,13 +90,62 @@ def add_estimates_from(path: str, log_or_log_path: str | Log):
     ]
     utils.serializer.write_json(m, path, indent=2)
 
-estimates = estimates_from('estimates.json')
+timings = timings_from('estimates.json')
+
+@cache
+def estimates_at(risk: float | None) -> dict[EstCmd, float]:
+    return {
+        RobotarmCmd('noop'): 0.5,
+        **estimates_of(timings, risk),
+    }
+
+estimates = {**estimates_at(None)}
 guesses: dict[EstCmd, float] = {}
+risk: float | None = None
+
+def set_risk(new_risk: float | None):
+    '''
+    Use the given percentile of the timings as estimates, see estimates_of.
+    Does nothing if this is already the risk in use.
+    '''
+    global risk
+    new_risk = new_risk or None
+    if new_risk == risk:
+        return
+    risk = new_risk
+    estimates.clear()
+    estimates.update(estimates_at(risk))
+    guesses.clear()
+
+def sample_timings(cmd: EstCmd) -> list[float]:
+    '''
+    The timings to draw durations of this command from. Commands with fewer
+    than two timings have none and keep their estimate.
+    '''
+    times = timings.get(normalize(cmd), [])
+    return times if len(times) > 1 else []
 
-estimates = {
-    RobotarmCmd('noop'): 0.5,
-    **estimates
-}
+def exact_duration(cmd: Duration) -> float | None:
+    '''
+    The exact length of the duration, if it has one that is not a variable
+    '''
+    if cmd.exactly is not None and not (exactly := Symbolic.wrap(cmd.exactly)).var_names:
+        return exactly.unwrap()
+    else:
+        return None
+
+def incubation_deviations(log: Log) -> list[tuple[LogEntry, float]]:
+    '''
+    How far each incubation with an exact duration in the log is from it
+    '''
+    return [
+        (x, abs(d - exactly))
+        for x in log
+        if isinstance(x.cmd, Duration)
+        if 'incubation' in x.cmd.name
+        if (exactly := exact_duration(x.cmd)) is not None
+        if (d := x.duration) is not None
+    ]
 
 def estimate(cmd: EstCmd) -> float:
     assert isinstance(cmd, EstCmd)
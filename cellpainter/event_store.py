@@ -0,0 +1,224 @@
+'''
+A SQLite store of the events of many runs
+
+Logs are imported into a table per kind of entry so that questions across
+runs are answered by queries instead of reading every log. Examples:
+
+    select count(distinct run_id) from commands join runs using (run_id)
+    where machine = 'wash' and protocol_path like '%5_W_%' and start_time >= '2022-03-01'
+
+    select strftime('%w', log_time) as weekday, avg(duration) from commands
+    where cmd_type = 'IncuCmd' and action = 'get' and duration is not null
+    group by weekday
+
+Importing is incremental: the part of a log imported is remembered and only
+entries appended since are added. Runs started with --store-events are
+imported when they finish. Files that are not event logs, such as logs in
+older formats, are not imported.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+from datetime import datetime, timedelta
+from pathlib import Path
+import os
+import sqlite3
+
+from . import utils
+from .commands import BiotekCmd, Checkpoint, Command, Duration, IncuCmd, RobotarmCmd, WaitForCheckpoint
+from .log import LogEntry
+
+Schema = '''
+    create table if not exists runs (
+        run_id       integer primary key,
+        log_filename text unique not null,
+        offset       integer not null default 0,
+        start_time   text,
+        pid          integer,
+        host         text,
+        git_HEAD     text,
+        completed    integer not null default 0
+    );
+
+    create table if not exists commands (
+        run_id        integer not null references runs,
+        log_time      text not null,
+        t             real not null,
+        t0            real,
+        duration      real,
+        cmd_type      text not null,
+        machine       text,
+        action        text,
+        name          text,
+        protocol_path text,
+        incu_loc      text,
+        id            text,
+        plate_id      text,
+        batch_index   integer,
+        step          text,
+        substep       text,
+        section       text,
+        thread_name   text
+    );
+
+    create table if not exists errors (
+        run_id    integer not null references runs,
+        log_time  text not null,
+        t         real not null,
+        message   text not null,
+        traceback text
+    );
+
+    create table if not exists messages (
+        run_id   integer not null references runs,
+        log_time text not null,
+        t        real not null,
+        msg      text not null
+    );
+
+    create index if not exists commands_cmd      on commands (cmd_type, machine, action, name);
+    create index if not exists commands_protocol on commands (protocol_path);
+    create index if not exists commands_plate    on commands (plate_id);
+    create index if not exists commands_run      on commands (run_id, t);
+    create index if not exists commands_time     on commands (log_time);
+    create index if not exists errors_run        on errors (run_id, t);
+    create index if not exists messages_run      on messages (run_id, t);
+    create index if not exists runs_start        on runs (start_time);
+'''
+
+def command_columns(cmd: Command) -> tuple[str, str | None, str | None, str | None, str | None, str | None]:
+    '''
+    The type, machine, action, name, protocol path and incubator location of a command
+    '''
+    machine = cmd.required_resource()
+    match cmd:
+        case BiotekCmd():
+            return 'BiotekCmd', machine, cmd.action, None, cmd.protocol_path, None
+        case IncuCmd():
+            return 'IncuCmd', machine, cmd.action, None, None, cmd.incu_loc
+        case RobotarmCmd():
+            return 'RobotarmCmd', machine, None, cmd.program_name, None, None
+        case Checkpoint() | Duration() | WaitForCheckpoint():
+            return cmd.__class__.__name__, machine, None, cmd.name, None, None
+        case _:
+            return cmd.__class__.__name__, machine, None, None, None, None
+
+def parse_entry(line: bytes) -> LogEntry:
+    x = utils.serializer.loads(line)
+    if not isinstance(x, LogEntry):
+        raise ValueError(f'Not a log entry: {line[:100]!r}')
+    return x
+
+@dataclass
+class EventStore:
+    path: str = 'cache/events.sqlite'
+    con: sqlite3.Connection = field(init=False)
+
+    def __post_init__(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.con = sqlite3.connect(self.path)
+        self.con.executescript(Schema)
+
+    def close(self):
+        self.con.close()
+
+    def import_log(self, log_filename: str, chunk_size: int = 1 << 24) -> int:
+        '''
+        Adds the entries appended to the log since it was last imported and
+        returns how many there were. A log that has shrunk is imported again.
+
+        The lines are read about chunk_size bytes at a time and each chunk is
+        committed with the offset it reaches, so memory use stays bounded and
+        an interrupted import continues from the last chunk. An incomplete last
+        line is left for the next import. A line that is not a log entry raises
+        ValueError, since then the file is not an event log.
+        '''
+        log_filename = os.path.normpath(log_filename)
+        row = self.con.execute('select run_id, offset from runs where log_filename = ?', (log_filename,)).fetchone()
+        with open(log_filename, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            run_id: int | None = None
+            offset = 0
+            if row is not None:
+                run_id, offset = cast(tuple[int, int], row)
+                if size < offset:
+                    self.drop_run(run_id)
+                    run_id, offset = None, 0
+            f.seek(offset)
+            count = 0
+            while lines := f.readlines(chunk_size):
+                complete = lines[-1].endswith(b'\n')
+                if not complete:
+                    lines.pop()
+                entries = [parse_entry(line) for line in lines if line.strip()]
+                offset += sum(len(line) for line in lines)
+                with self.con:
+                    if run_id is None:
+                        run_id = self.con.execute('insert into runs (log_filename) values (?)', (log_filename,)).lastrowid
+                        assert run_id is not None
+                    self.insert(run_id, entries)
+                    self.con.execute('update runs set offset = ? where run_id = ?', (offset, run_id))
+                count += len(entries)
+                if not complete:
+                    break
+        return count
+
+    def drop_run(self, run_id: int):
+        with self.con:
+            for table in ['commands', 'errors', 'messages', 'runs']:
+                self.con.execute(f'delete from {table} where run_id = ?', (run_id,))
+
+    def insert(self, run_id: int, entries: list[LogEntry]):
+        commands: list[tuple[Any, ...]] = []
+        errors: list[tuple[Any, ...]] = []
+        messages: list[tuple[Any, ...]] = []
+        for x in entries:
+            if x.cmd is not None:
+                m = x.metadata
+                commands += [(
+                    run_id, x.log_time, x.t, x.t0, x.duration,
+                    *command_columns(x.cmd),
+                    m.id or None, m.plate_id, m.batch_index, m.step or None,
+                    m.substep or None, m.section or None, m.thread_name,
+                )]
+            if x.err:
+                errors += [(run_id, x.log_time, x.t, x.err.message, x.err.traceback)]
+            if x.msg:
+                messages += [(run_id, x.log_time, x.t, x.msg)]
+            if rm := x.runtime_metadata:
+                self.con.execute(
+                    'update runs set pid = ?, host = ?, git_HEAD = ? where run_id = ?',
+                    (rm.pid, rm.host, rm.git_HEAD, run_id),
+                )
+            if x.metadata.completed:
+                self.con.execute('update runs set completed = 1 where run_id = ?', (run_id,))
+        self.con.executemany(f'insert into commands values ({", ".join("?" * 18)})', commands)
+        self.con.executemany('insert into errors values (?, ?, ?, ?, ?)', errors)
+        self.con.executemany('insert into messages values (?, ?, ?, ?)', messages)
+        if entries:
+            first = entries[0]
+            start_time = datetime.fromisoformat(first.log_time) - timedelta(seconds=first.t)
+            self.con.execute(
+                'update runs set start_time = coalesce(start_time, ?) where run_id = ?',
+                (str(start_time), run_id),
+            )
+
+    def import_logs(self, path: str) -> dict[str, int | str]:
+        '''
+        Imports a log or all logs in a directory. Returns the number of
+        entries added per log, or why it could not be imported.
+        '''
+        paths = sorted(Path(path).rglob('*.jsonl')) if os.path.isdir(path) else [Path(path)]
+        out: dict[str, int | str] = {}
+        for p in paths:
+            try:
+                out[str(p)] = self.import_log(str(p))
+            except Exception as e:
+                out[str(p)] = repr(e)
+        return out
+
+    def query(self, sql: str, params: Sequence[Any] = ()) -> tuple[list[str], list[tuple[Any, ...]]]:
+        cur = self.con.execute(sql, params)
+        columns = [d[0] for d in cur.description or []]
+        return columns, cur.fetchall()
@@ -1,9 +1,18 @@
 from __future__ import annotations
-from typing import Iterator
+from dataclasses import dataclass, field
+from typing import Any, Callable, Coroutine, Iterator, Literal
 
+import asyncio
 import contextlib
+import heapq
 import os
 import platform
+import signal
+import sys
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from pathlib import Path
 
@@ -13,6 +22,8 @@ from .log import (
     RuntimeMetadata,
     LogEntry,
     Log,
+    Error,
+    Snapshot,
 )
 
 from .commands import (
@@ -32,27 +43,54 @@ from .commands import (
     WaitForResource,
 )
 from .runtime import RuntimeConfig, Runtime, dry_run
+from .timelike import EventTime
+from .event_store import EventStore
 from . import commands
 from . import constraints
 from . import utils
 from .symbolic import Symbolic
+from .critical_path import critical_path
 from .moves import movelists, MoveList
 from . import bioteks
 from . import incubator
 from .estimates import estimate, EstCmd
 from . import estimates
 
-def execute(cmd: Command, runtime: Runtime, metadata: Metadata):
+Event = (
+    tuple[Literal['sleep'], float]
+    | tuple[Literal['wait', 'checkpoint'], str]
+    | tuple[Literal['fork'], str, 'Events']
+    | tuple[Literal['call'], str, Callable[[], None]]
+)
+Events = Iterator[Event]
+
+def simulated_duration(runtime: Runtime, cmd: EstCmd, est: float) -> float:
+    timelike = runtime.timelike
+    assert isinstance(timelike, EventTime)
+    return timelike.duration(cmd, est)
+
+def execute_events(cmd: Command, runtime: Runtime, metadata: Metadata) -> Events:
+    '''
+    Interprets the commands of one thread of a program. The entries are logged
+    and the effects applied here, and what the thread has to do is yielded for
+    the backend to carry out: sleeping, waiting for a checkpoint, reaching a
+    checkpoint, forking a thread and calling an instrument. On a simulated
+    runtime the instruments are not called, they sleep their simulated duration.
+
+    The backends are execute with threads, execute_async with asyncio tasks
+    and simulate with a discrete event loop.
+    '''
+    simulated = isinstance(runtime.timelike, EventTime)
     if isinstance(cmd, EstCmd) and metadata.est is None:
         metadata = metadata.merge(Metadata(est=estimate(cmd)))
     entry = LogEntry(cmd=cmd, metadata=metadata)
     match cmd:
         case Meta():
-            execute(cmd.command, runtime, metadata.merge(cmd.metadata))
+            yield from execute_events(cmd.command, runtime, metadata.merge(cmd.metadata))
 
         case Seq():
             for c in cmd.commands:
-                execute(c, runtime, metadata)
+                yield from execute_events(c, runtime, metadata)
 
         case Info():
             runtime.log(entry.add(msg=cmd.msg))
@@ -62,55 +100,67 @@ def execute(cmd: Command, runtime: Runtime, metadata: Metadata):
             assert isinstance(secs, (float, int))
             entry = entry.add(Metadata(sleep_secs=secs))
             with runtime.timeit(entry):
-                runtime.sleep(secs, entry)
+                yield 'sleep', runtime.log_sleep(secs, entry)
 
         case Checkpoint():
             runtime.checkpoint(cmd.name, entry)
+            yield 'checkpoint', cmd.name
 
         case WaitForCheckpoint():
             plus_secs = cmd.plus_secs
             assert isinstance(plus_secs, (float, int))
             msg = f'{Symbolic.var(str(cmd.name)) + plus_secs}'
-            t0 = runtime.wait_for_checkpoint(cmd.name)
+            yield 'wait', cmd.name
+            t0 = runtime.checkpoint_times[cmd.name]
             desired_point_in_time = t0 + plus_secs
             delay = desired_point_in_time - runtime.monotonic()
             secs = round(delay, 3)
             entry = entry.add(msg=msg, metadata=Metadata(sleep_secs=secs))
             with runtime.timeit(entry):
-                runtime.sleep(delay, entry)
+                yield 'sleep', runtime.log_sleep(delay, entry)
 
         case Duration():
-            t0 = runtime.wait_for_checkpoint(cmd.name)
+            yield 'wait', cmd.name
+            t0 = runtime.checkpoint_times[cmd.name]
             runtime.log(entry, t0=t0)
 
         case Fork():
             thread_name = cmd.thread_name
             assert thread_name
             fork_metadata = metadata.merge(Metadata(thread_name=thread_name, thread_resource=cmd.resource))
-            @runtime.spawn
-            def fork():
-                assert thread_name
-                runtime.register_thread(thread_name)
-                execute(cmd.command, runtime, fork_metadata)
-                runtime.thread_done()
+            yield 'fork', thread_name, execute_events(cmd.command, runtime, fork_metadata)
 
         case RobotarmCmd():
             with runtime.timeit(entry):
-                if runtime.config.robotarm_env.mode == 'noop':
-                    runtime.sleep(estimate(cmd), entry.add(Metadata(dry_run_sleep=True)))
+                if simulated:
+                    secs = simulated_duration(runtime, cmd, estimate(cmd))
+                    yield 'sleep', runtime.log_sleep(secs, entry.add(Metadata(dry_run_sleep=True)))
+                elif runtime.config.robotarm_env.mode == 'noop':
+                    yield 'sleep', runtime.log_sleep(estimate(cmd), entry.add(Metadata(dry_run_sleep=True)))
                 else:
-                    movelist = MoveList(movelists[cmd.program_name])
-                    arm = runtime.get_robotarm(include_gripper=movelist.has_gripper())
-                    arm.execute_moves(movelist, name=cmd.program_name)
-                    arm.close()
+                    yield 'call', 'robotarm', partial(robotarm_execute, runtime, cmd)
 
         case BiotekCmd():
             with runtime.timeit(entry):
-                bioteks.execute(runtime, entry, cmd.machine, cmd.protocol_path, cmd.action)
+                if simulated:
+                    if cmd.machine not in ('wash', 'disp'):
+                        raise ValueError(f'No such biotek {cmd.machine=}')
+                    est = entry.metadata.est
+                    assert isinstance(est, float)
+                    secs = simulated_duration(runtime, cmd, est)
+                    yield 'sleep', runtime.log_sleep(secs, entry.add(Metadata(dry_run_sleep=True)))
+                else:
+                    yield 'call', cmd.machine, partial(bioteks.execute, runtime, entry, cmd.machine, cmd.protocol_path, cmd.action)
 
         case IncuCmd():
             with runtime.timeit(entry):
-                incubator.execute(runtime, entry, cmd.action, cmd.incu_loc)
+                if simulated:
+                    est = entry.metadata.est
+                    assert isinstance(est, float)
+                    secs = simulated_duration(runtime, cmd, est)
+                    yield 'sleep', runtime.log_sleep(secs, entry.add(Metadata(dry_run_sleep=True)))
+                else:
+                    yield 'call', 'incu', partial(incubator.execute, runtime, entry, cmd.action, cmd.incu_loc)
 
         case WaitForResource():
             raise ValueError('Cannot execute WaitForResource, run Command.make_resource_checkpoints first')
@@ -125,6 +175,209 @@ def execute(cmd: Command, runtime: Runtime, metadata: Metadata):
         case _:
             pass
 
+def execute(cmd: Command, runtime: Runtime, metadata: Metadata):
+    '''
+    Runs the command in this thread. Forked threads are started as threads
+    that run until they are done, but the run ends when this thread is done.
+    '''
+    execute_thread(execute_events(cmd, runtime, metadata), runtime)
+
+def execute_thread(events: Events, runtime: Runtime):
+    for event in events:
+        match event:
+            case 'sleep', secs:
+                runtime.timelike.sleep(secs)
+            case 'wait', name:
+                runtime.wait_for_checkpoint(name)
+            case 'checkpoint', _:
+                pass
+            case 'fork', thread_name, child:
+                fork_thread(thread_name, child, runtime)
+            case 'call', _, f:
+                f()
+
+def fork_thread(thread_name: str, events: Events, runtime: Runtime):
+    @runtime.spawn
+    def fork():
+        runtime.register_thread(thread_name)
+        execute_thread(events, runtime)
+        runtime.thread_done()
+
+def simulate(program: Command, runtime: Runtime):
+    '''
+    Runs the program on a runtime with EventTime as a discrete event simulation.
+
+    Each thread of the program is a generator from execute_events. The ready
+    threads run in turn until they sleep, wait or finish. When no thread is
+    ready the time skips to the earliest wake up in the heap of sleeping threads.
+    The order of threads that run at the same time is as with the threads of
+    execute: forked threads run before the thread that forked them continues,
+    the thread that went to sleep last runs first if it wakes up and the others
+    that wake up at the same time are resumed in the order they were started.
+    As with execute, the simulation ends when the main thread is done.
+    '''
+    timelike = runtime.timelike
+    assert isinstance(timelike, EventTime)
+    assert runtime.incu is None and runtime.wash is None and runtime.disp is None
+
+    started: list[Events] = []
+    ready: deque[tuple[int, Events]] = deque()
+    sleeping: list[tuple[float, int, Events]] = []
+    waiting: dict[str, list[tuple[int, Events]]] = {}
+
+    def start(events: Events) -> tuple[int, Events]:
+        started.append(events)
+        return len(started) - 1, events
+
+    ready.append(start(execute_events(program, runtime, Metadata())))
+    last_asleep: int | None = None
+    while True:
+        while ready:
+            thread = i, events = ready.popleft()
+            for event in events:
+                match event:
+                    case 'sleep', secs if secs > 0:
+                        heapq.heappush(sleeping, (timelike.now + secs, i, events))
+                        last_asleep = i
+                        break
+                    case 'sleep', _:
+                        pass
+                    case 'wait', name if name not in runtime.checkpoint_times:
+                        waiting.setdefault(name, []).append(thread)
+                        last_asleep = None
+                        break
+                    case 'wait', _:
+                        pass
+                    case 'checkpoint', name:
+                        ready.extendleft(waiting.pop(name, []))
+                    case 'fork', _, child:
+                        ready.appendleft(thread)
+                        ready.appendleft(start(child))
+                        break
+                    case 'call', _, _:
+                        raise ValueError('Cannot call instruments in a simulation')
+            else:
+                if i == 0:
+                    # the main thread is done
+                    return
+                last_asleep = None
+        if not sleeping:
+            break
+        timelike.now = sleeping[0][0]
+        woken: list[tuple[int, Events]] = []
+        while sleeping and sleeping[0][0] - timelike.now < 1e-4:
+            _, i, events = heapq.heappop(sleeping)
+            woken.append((i, events))
+        ready.extend(sorted(woken, key=lambda thread: (thread[0] != last_asleep, thread[0])))
+    raise ValueError(f'Threads blocked indefinitely on {", ".join(waiting)}')
+
+def execute_on(program: Command, runtime: Runtime):
+    if isinstance(runtime.timelike, EventTime):
+        simulate(program, runtime)
+    elif runtime.config.use_asyncio:
+        asyncio.run(run_async(program, runtime))
+    else:
+        execute(program, runtime, Metadata())
+
+def robotarm_execute(runtime: Runtime, cmd: RobotarmCmd):
+    movelist = MoveList(movelists[cmd.program_name])
+    with_gripper = runtime.config.robotarm_env.mode == 'execute' and movelist.has_gripper()
+    arm = runtime.robotarm_connection()
+    arm.execute_moves(movelist, name=cmd.program_name, with_gripper=with_gripper)
+
+@dataclass
+class AsyncRun:
+    '''
+    The state of a program run by execute_async: the tasks of its threads, one
+    event per checkpoint and one executor per instrument for the blocking calls.
+    The executors have one worker each since an instrument runs one command at
+    a time.
+    '''
+    runtime: Runtime
+    tasks: list[asyncio.Task[None]] = field(default_factory=list[asyncio.Task[None]])
+    checkpoints: defaultdict[str, asyncio.Event] = field(default_factory=lambda: defaultdict(asyncio.Event))
+    executors: dict[str, ThreadPoolExecutor] = field(default_factory=dict[str, ThreadPoolExecutor])
+
+    def spawn(self, coro: Coroutine[Any, Any, None], thread_name: str):
+        self.tasks.append(asyncio.create_task(coro, name=thread_name))
+
+    async def wait_for_checkpoint(self, name: str):
+        if name not in self.runtime.checkpoint_times:
+            await self.checkpoints[name].wait()
+
+    async def call(self, instrument: str, f: Callable[[], None]):
+        if instrument not in self.executors:
+            self.executors[instrument] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=instrument)
+        await asyncio.get_running_loop().run_in_executor(self.executors[instrument], f)
+
+    def shutdown(self):
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+async def execute_async(cmd: Command, run: AsyncRun, metadata: Metadata):
+    '''
+    Like execute but forks are asyncio tasks and the instrument calls run in
+    the executors of the AsyncRun.
+    '''
+    await execute_task(execute_events(cmd, run.runtime, metadata), run)
+
+async def execute_task(events: Events, run: AsyncRun):
+    for event in events:
+        match event:
+            case 'sleep', secs:
+                await asyncio.sleep(secs)
+            case 'wait', name:
+                await run.wait_for_checkpoint(name)
+            case 'checkpoint', name:
+                run.checkpoints[name].set()
+            case 'fork', thread_name, child:
+                run.spawn(execute_task(child, run), thread_name)
+            case 'call', instrument, f:
+                await run.call(instrument, f)
+
+async def run_async(program: Command, runtime: Runtime):
+    '''
+    Runs the program until all its threads are done. If a thread fails the
+    others are cancelled. On SIGINT, SIGQUIT or SIGTERM all threads are
+    cancelled and the robot arm is stopped.
+    '''
+    run = AsyncRun(runtime)
+    loop = asyncio.get_running_loop()
+    this = asyncio.current_task()
+    assert this
+    received: list[int] = []
+
+    def on_signal(signum: int):
+        received.append(signum)
+        this.cancel()
+
+    signums = [signal.SIGINT, signal.SIGQUIT, signal.SIGTERM]
+    handlers = {signum: signal.getsignal(signum) for signum in signums}
+    for signum in signums:
+        loop.add_signal_handler(signum, on_signal, signum)
+    try:
+        run.spawn(execute_async(program, run, Metadata()), 'main')
+        while pending := [t for t in run.tasks if not t.done()]:
+            done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_EXCEPTION)
+            for t in done:
+                if not t.cancelled() and (e := t.exception()):
+                    raise e
+    except asyncio.CancelledError:
+        if not received:
+            raise
+        signum = received[0]
+        pid = os.getpid()
+        runtime.log(LogEntry(err=Error(f'Received {signal.strsignal(signum)}, shutting down ({pid=})')))
+        runtime.stop_arm()
+        sys.exit(1)
+    finally:
+        for t in run.tasks:
+            t.cancel()
+        for signum, handler in handlers.items():
+            loop.remove_signal_handler(signum)
+            signal.signal(signum, handler)
+        run.shutdown()
+
 @contextlib.contextmanager
 def make_runtime(config: RuntimeConfig, metadata: dict[str, str]) -> Iterator[Runtime]:
     metadata = {
@@ -150,8 +403,14 @@ def make_runtime(config: RuntimeConfig, metadata: dict[str, str]) -> Iterator[Ru
 
     runtime = config.make_runtime()
 
-    with runtime.excepthook():
-        yield runtime
+    try:
+        with runtime.excepthook():
+            yield runtime
+    finally:
+        runtime.close()
+        if config.event_store and log_filename:
+            with contextlib.closing(EventStore(config.event_store)) as store:
+                store.import_log(log_filename)
 
 def check_correspondence(program: Command, est_entries: Log, expected_ends: dict[str, float]):
     matches = 0
@@ -187,25 +446,46 @@ def check_correspondence(program: Command, est_entries: Log, expected_ends: dict
     if mismatches or not matches:
         print(f'{matches=} {mismatches=} {len(expected_ends)=}')
 
-def execute_program(config: RuntimeConfig, program: Command, metadata: dict[str, str], for_visualizer: bool = False) -> Log:
+def schedule_program(program: Command, solve_timeout: float | None = None, integer_time: bool = False) -> tuple[Command, Command, constraints.OptimalResult]:
+    '''
+    Assigns ids and resource checkpoints and solves the schedule.
+
+    Returns the program before and after its schedule was resolved and the schedule.
+    '''
+    program = program.assign_ids()
+    program = program.make_resource_checkpoints()
+    with utils.timeit('constraints') as info:
+        resolved, opt = constraints.optimize(program, timeout=solve_timeout, integer=integer_time)
+        info.update(opt.stats)
+    return program, resolved, opt
+
+def execute_program(config: RuntimeConfig, program: Command, metadata: dict[str, str], for_visualizer: bool = False, solve_timeout: float | None = None, integer_time: bool = False, schedule: dict[str, Any] | None = None) -> Log:
+    '''
+    The schedule is the program before its variables were resolved together with
+    their values. It is saved so that resume can reschedule the rest of the program.
+    Resumed programs are already resolved and pass their schedule here, if any.
+    '''
     program = program.remove_noops()
     resume_config = config.resume_config
     if not resume_config:
-        program = program.assign_ids()
-
-    if not resume_config:
-        with utils.timeit('constraints'):
-            program, expected_ends = constraints.optimize(program)
+        symbolic, program, opt = schedule_program(program, solve_timeout=solve_timeout, integer_time=integer_time)
+        expected_ends = opt.expected_ends
+        schedule = {'program': symbolic, 'env': opt.env}
     else:
         expected_ends = {}
 
     with utils.timeit('estimates'):
         with make_runtime(dry_run.replace(log_to_file=False, resume_config=config.resume_config), {}) as runtime_est:
-            execute(program, runtime_est, Metadata())
+            execute_on(program, runtime_est)
         est_entries = runtime_est.get_log()
 
     if for_visualizer:
-        return est_entries
+        with utils.timeit('critical path'):
+            slack = critical_path(program).slack()
+        return Log(
+            e.add(Metadata(slack=slack[i])) if (i := e.metadata.id) in slack else e
+            for e in est_entries
+        )
 
     if not resume_config:
         with utils.timeit('check correspondence'):
@@ -219,6 +499,7 @@ def execute_program(config: RuntimeConfig, program: Command, metadata: dict[str,
     estimates_filename     = cache / (now_str + '_estimates.jsonl')
     program_filename       = cache / (now_str + '_program.json')
     running_log_filename   = cache / (now_str + '_running.jsonl')
+    schedule_filename      = cache / (now_str + '_schedule.json')
 
     config = config.replace(running_log_filename=str(running_log_filename))
 
@@ -240,6 +521,8 @@ def execute_program(config: RuntimeConfig, program: Command, metadata: dict[str,
 
         utils.serializer.write_jsonl(est_entries, estimates_filename)
         utils.serializer.write_json(program, program_filename, indent=2)
+        if schedule:
+            utils.serializer.write_json(schedule, schedule_filename)
         running_log_filename.touch()
 
         runtime_metadata = RuntimeMetadata(
@@ -250,10 +533,17 @@ def execute_program(config: RuntimeConfig, program: Command, metadata: dict[str,
             estimates_filename   = str(estimates_filename) ,
             program_filename     = str(program_filename),
             running_log_filename = str(running_log_filename),
+            schedule_filename    = str(schedule_filename) if schedule else '',
         )
 
         runtime.log(LogEntry(runtime_metadata=runtime_metadata))
-        execute(program, runtime, Metadata())
+        runtime.start_snapshots(Snapshot(
+            start_time=str(runtime.start_time),
+            runtime_metadata=runtime_metadata,
+            next_id=program.next_id(),
+            program_hash=Snapshot.hash_program(str(program_filename)),
+        ))
+        execute_on(program, runtime)
         runtime.log(LogEntry(metadata=Metadata(completed=True)))
 
         for line in runtime.get_log().group_durations_for_display():
@@ -2,8 +2,13 @@ from __future__ import annotations
 from dataclasses import *
 from typing import *
 
+import bisect
+import hashlib
 import math
+import os
+import re
 from datetime import datetime, timedelta
+from threading import RLock
 
 from . import utils
 from .commands import Metadata, Command, Checkpoint, BiotekCmd, Duration, Info, IncuCmd, RobotarmCmd
@@ -20,6 +25,53 @@ class Running:
     def empty() -> Running:
         return Running(entries=[], world={})
 
+@dataclass(frozen=True)
+class RunningDelta:
+    '''
+    The change of the running state since the previous line of the running log.
+    The running log starts with a full Running state and repeats it now and then,
+    the lines in between are deltas.
+    '''
+    removed: list[int] = field(default_factory=list[int])
+    added: list[LogEntry] = field(default_factory=lambda: list[LogEntry]())
+    world: dict[str, str | None] = field(default_factory=dict[str, str | None])
+
+    @staticmethod
+    def diff(prev: Running, next: Running) -> RunningDelta:
+        return RunningDelta(
+            removed=[
+                i
+                for i, e in enumerate(prev.entries)
+                if not any(e is n for n in next.entries)
+            ],
+            added=[
+                n
+                for n in next.entries
+                if not any(e is n for e in prev.entries)
+            ],
+            world={
+                k: next.world.get(k)
+                for k in prev.world.keys() | next.world.keys()
+                if prev.world.get(k) != next.world.get(k)
+            },
+        )
+
+    def apply(self, running: Running) -> Running:
+        world = {**running.world}
+        for k, v in self.world.items():
+            if v is None:
+                world.pop(k, None)
+            else:
+                world[k] = v
+        return Running(
+            entries=[
+                e
+                for i, e in enumerate(running.entries)
+                if i not in self.removed
+            ] + self.added,
+            world=world,
+        )
+
 @dataclass(frozen=True)
 class RuntimeMetadata:
     pid: int
@@ -29,6 +81,59 @@ class RuntimeMetadata:
     estimates_filename: str
     program_filename: str
     running_log_filename: str
+    schedule_filename: str = ''
+
+def snapshot_filename(log_filename: str) -> str:
+    return re.sub(r'\.jsonl$', '', log_filename) + '.snapshot.json'
+
+@dataclass(frozen=True)
+class Snapshot:
+    '''
+    What resume needs to know about a run up to time t. The runtime writes it
+    now and then next to the event log, see snapshot_filename, so that resume
+    can read it and the entries logged after it instead of the whole log.
+    '''
+    t: float = -math.inf
+    start_time: str = ''
+    runtime_metadata: RuntimeMetadata | None = None
+    finished: list[str] = field(default_factory=list[str])
+    checkpoint_times: dict[str, float] = field(default_factory=dict[str, float])
+    next_id: int = 0
+    program_hash: str = ''
+
+    def update(self, entries: Log) -> Snapshot:
+        '''
+        This snapshot updated with entries logged after it
+        '''
+        if not entries:
+            return self
+        return replace(
+            self,
+            t=max(self.t, entries.max_t()),
+            start_time=self.start_time or str(entries.zero_time()),
+            runtime_metadata=entries.runtime_metadata() or self.runtime_metadata,
+            finished=sorted({*self.finished, *entries.finished()}),
+            checkpoint_times={**self.checkpoint_times, **entries.checkpoints()},
+        )
+
+    @staticmethod
+    def hash_program(program_filename: str) -> str:
+        with open(program_filename, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+
+    @staticmethod
+    def read(log_filename: str) -> Snapshot:
+        '''
+        The latest snapshot of a log updated with the entries after it. Logs
+        without a snapshot are read in full.
+        '''
+        path = snapshot_filename(log_filename)
+        if os.path.exists(path):
+            snapshot = utils.serializer.read_json(path)
+            assert isinstance(snapshot, Snapshot)
+            return snapshot.update(Log.read_tail(log_filename, snapshot.t))
+        else:
+            return Snapshot().update(Log.read_jsonl(log_filename))
 
 @dataclass(frozen=True)
 class LogEntry:
@@ -40,6 +145,7 @@ class LogEntry:
     err: Error | None       = None
     msg: str | None         = None
     running: Running | None = None
+    running_delta: RunningDelta | None = None
     runtime_metadata: RuntimeMetadata | None = None
 
     def init(
@@ -98,7 +204,173 @@ class Error:
     message: str
     traceback: str | None = None
 
+command_kinds: dict[type, type | None] = {}
+
+def command_kind(cls: type) -> type | None:
+    '''
+    Which of Checkpoint, Duration and Info the command class is, looked up
+    once per class since isinstance checks on the abstract commands are slow.
+    '''
+    kind = command_kinds.get(cls, Command)
+    if kind is Command:
+        kind = command_kinds[cls] = next((k for k in (Checkpoint, Duration, Info) if issubclass(cls, k)), None)
+    return kind
+
+@dataclass
+class LogIndex:
+    '''
+    Maps over the entries of a log, made in one pass on the first query and
+    extended when the log has been appended to. The values are positions in
+    the log.
+    '''
+    n: int = 0
+    by_id: dict[str, list[int]] = field(default_factory=dict[str, list[int]])
+    by_cmd: dict[type, list[int]] = field(default_factory=dict[type, list[int]])
+    by_plate: dict[str, list[int]] = field(default_factory=dict[str, list[int]])
+    by_resource: dict[str, list[int]] = field(default_factory=dict[str, list[int]])
+    section_starts: dict[str, float] = field(default_factory=dict[str, float])
+    finished: set[str] = field(default_factory=set[str])
+    checkpoints: dict[str, float] = field(default_factory=dict[str, float])
+    durations: dict[str, float] = field(default_factory=dict[str, float])
+    errors: list[int] = field(default_factory=list[int])
+    last_runtime_metadata: int | None = None
+    last_running: int | None = None
+    running_deltas: list[int] = field(default_factory=list[int])
+    completed: bool = False
+    ts: list[float] = field(default_factory=list[float])
+    t_sorted: bool = True
+    lock: RLock = field(default_factory=RLock)
+
+    def extend(self, log: list[LogEntry]):
+        with self.lock:
+            ts = self.ts
+            for i in range(self.n, len(log)):
+                x = log[i]
+                m = x.metadata
+                cmd = x.cmd
+                kind = command_kind(cmd.__class__)
+                if id := m.id:
+                    self.by_id.setdefault(id, []).append(i)
+                    if isinstance(x.t0, float) or kind is Info:
+                        self.finished.add(id)
+                if cmd is not None:
+                    self.by_cmd.setdefault(cmd.__class__, []).append(i)
+                    if kind is Checkpoint:
+                        self.checkpoints[cast(Checkpoint, cmd).name] = x.t
+                    elif kind is Duration and (d := x.duration) is not None:
+                        self.durations[cast(Duration, cmd).name] = d
+                if p := m.plate_id:
+                    self.by_plate.setdefault(p, []).append(i)
+                if r := m.thread_resource:
+                    self.by_resource.setdefault(r, []).append(i)
+                if section := m.section:
+                    self.section_starts[section] = x.t
+                if m.completed:
+                    self.completed = True
+                if x.err:
+                    self.errors.append(i)
+                if x.runtime_metadata:
+                    self.last_runtime_metadata = i
+                if x.running:
+                    self.last_running = i
+                    self.running_deltas = []
+                elif x.running_delta:
+                    self.running_deltas.append(i)
+                if ts and x.t < ts[-1]:
+                    self.t_sorted = False
+                ts.append(x.t)
+            self.n = len(log)
+
 class Log(list[LogEntry]):
+    def __reduce__(self):
+        return Log, (list(self),)
+
+    def indexed(self) -> LogIndex:
+        '''
+        The index of this log, made on first use and extended with the entries
+        appended since. Other changes drop it, see _mutated.
+        '''
+        index: LogIndex | None = self.__dict__.get('_index')
+        if index is None:
+            index = self.__dict__['_index'] = LogIndex()
+        if index.n != len(self):
+            index.extend(self)
+        return index
+
+    def _mutated(self, start: int = 0):
+        '''
+        Called before every change of the log with the position of the first
+        entry that changes. The index is kept if it only covers entries before
+        that, which is the case for appends, and dropped otherwise.
+        '''
+        index: LogIndex | None = self.__dict__.get('_index')
+        if index is not None and start < index.n:
+            del self.__dict__['_index']
+
+    def append(self, x: LogEntry):
+        self._mutated(len(self))
+        super().append(x)
+
+    def extend(self, xs: Iterable[LogEntry]):
+        self._mutated(len(self))
+        super().extend(xs)
+
+    def __iadd__(self, xs: Iterable[LogEntry]):
+        self._mutated(len(self))
+        return super().__iadd__(xs)
+
+    def insert(self, i: SupportsIndex, x: LogEntry):
+        self._mutated()
+        super().insert(i, x)
+
+    @overload
+    def __setitem__(self, i: SupportsIndex, x: LogEntry) -> None: ...
+    @overload
+    def __setitem__(self, i: slice, x: Iterable[LogEntry]) -> None: ...
+    def __setitem__(self, i: Any, x: Any) -> None:
+        self._mutated()
+        super().__setitem__(i, x)
+
+    def __delitem__(self, i: SupportsIndex | slice):
+        self._mutated()
+        super().__delitem__(i)
+
+    def __imul__(self, n: SupportsIndex):
+        self._mutated()
+        return super().__imul__(n)
+
+    def pop(self, i: SupportsIndex = -1) -> LogEntry:
+        self._mutated()
+        return super().pop(i)
+
+    def remove(self, x: LogEntry):
+        self._mutated()
+        super().remove(x)
+
+    def sort(self, *, key: Callable[[LogEntry], Any], reverse: bool = False):
+        self._mutated()
+        super().sort(key=key, reverse=reverse)
+
+    def reverse(self):
+        self._mutated()
+        super().reverse()
+
+    def clear(self):
+        self._mutated()
+        super().clear()
+
+    def with_id(self, id: str) -> Log:
+        return Log(self[i] for i in self.indexed().by_id.get(id, []))
+
+    def with_cmd(self, cmd_type: type) -> Log:
+        return Log(self[i] for i in self.indexed().by_cmd.get(cmd_type, []))
+
+    def with_plate(self, plate_id: str) -> Log:
+        return Log(self[i] for i in self.indexed().by_plate.get(plate_id, []))
+
+    def with_resource(self, resource: str) -> Log:
+        return Log(self[i] for i in self.indexed().by_resource.get(resource, []))
+
     @staticmethod
     def read_jsonl(filename: str):
         out = Log(utils.serializer.read_jsonl(filename))
@@ -109,35 +381,50 @@ class Log(list[LogEntry]):
     def write_jsonl(self, filename: str):
         return utils.serializer.write_jsonl(self, filename)
 
+    @staticmethod
+    def read_tail(filename: str, t: float) -> Log:
+        '''
+        The entries logged at time t or later, read from the end of the file
+        '''
+        tail = Log()
+        with open(filename, 'rb') as f:
+            for line in reversed_lines(f):
+                x = utils.serializer.loads(line)
+                assert isinstance(x, LogEntry)
+                if x.t < t:
+                    break
+                tail.append(x)
+        return Log(tail[::-1])
+
+    @staticmethod
+    def read_running(filename: str, t: float | None = None) -> Running | None:
+        '''
+        The running state at time t, or at the end, of a running log. Only the
+        tail of the file from the last state before t is read.
+        '''
+        tail = Log()
+        with open(filename, 'rb') as f:
+            for line in reversed_lines(f):
+                x = utils.serializer.loads(line)
+                assert isinstance(x, LogEntry)
+                if t is not None and x.t > t:
+                    continue
+                tail.append(x)
+                if x.running:
+                    break
+        return Log(tail[::-1]).running()
+
     def finished(self) -> set[str]:
-        return {
-            i
-            for x in self
-            if x.is_end_or_inf()
-            if (i := x.metadata.id)
-        }
+        return {*self.indexed().finished}
 
     def ids(self) -> set[str]:
-        return {
-            i
-            for x in self
-            if (i := x.metadata.id)
-        }
+        return {*self.indexed().by_id}
 
     def checkpoints(self) -> dict[str, float]:
-        return {
-            x.cmd.name: x.t
-            for x in self
-            if isinstance(x.cmd, Checkpoint)
-        }
+        return {**self.indexed().checkpoints}
 
     def durations(self) -> dict[str, float]:
-        return {
-            x.cmd.name: d
-            for x in self
-            if isinstance(x.cmd, Duration)
-            if (d := x.duration) is not None
-        }
+        return {**self.indexed().durations}
 
     def group_durations(self: Log):
         groups = utils.group_by(self.durations().items(), key=lambda s: s[0].rstrip(' 0123456789'))
@@ -161,83 +448,72 @@ class Log(list[LogEntry]):
             yield k + ' [' + ', '.join(vs) + ']'
 
     def errors(self, current_runtime_only: bool=True) -> list[tuple[Error, LogEntry]]:
+        index = self.indexed()
         start = 0
-        if current_runtime_only:
-            for i, x in list(enumerate(self))[::-1]:
-                if x.runtime_metadata:
-                    start = i
-                    break
+        if current_runtime_only and index.last_runtime_metadata is not None:
+            start = index.last_runtime_metadata
         return [
             (err, x)
-            for x in self[start:]
-            if (err := x.err)
+            for i in index.errors
+            if i >= start
+            if (err := (x := self[i]).err)
         ]
 
     def section_starts(self) -> dict[str, float]:
-        return {
-            section: x.t
-            for x in self
-            if (section := x.metadata.section)
-        }
+        return {**self.indexed().section_starts}
 
     def min_t(self):
+        index: LogIndex | None = self.__dict__.get('_index')
+        if index and index.n == len(self) and index.t_sorted:
+            return index.ts[0] if index.ts else 0.0
         return min((x.t for x in self), default=0.0)
 
     def max_t(self):
+        index: LogIndex | None = self.__dict__.get('_index')
+        if index and index.n == len(self) and index.t_sorted:
+            return index.ts[-1] if index.ts else 0.0
         return max((x.t for x in self), default=0.0)
 
     def length(self):
         return self.max_t() - self.min_t()
 
     def group_by_section(self, first_section_name: str='begin') -> dict[str, Log]:
-        xs = Log()
-        out = {first_section_name: xs}
-        for x in sorted(self, key=lambda e: (e.t0 or e.t) if isinstance(e.cmd, BiotekCmd | IncuCmd | RobotarmCmd) else e.t):
-            if section := x.metadata.section:
-                xs = Log()
-                out[section] = xs
-            xs.append(x)
-        if not out[first_section_name]:
-            out.pop(first_section_name)
-        out = {
-            k: v if not next_kv else Log(v + [LogEntry(t=next_kv[1].min_t() - 0.05)])
-            for (k, v), next_kv in utils.iterate_with_next(list(out.items()))
-        }
-        return out
+        return split_sections(sorted(self, key=section_key), first_section_name)
 
     def running(self) -> Running | None:
-        for x in self[::-1]:
-            if m := x.running:
-                return m
+        index = self.indexed()
+        if index.last_running is not None:
+            m = self[index.last_running].running
+            assert m
+            for i in index.running_deltas:
+                if d := self[i].running_delta:
+                    m = d.apply(m)
+            return m
 
     def runtime_metadata(self) -> RuntimeMetadata | None:
-        for x in self[::-1]:
-            if m := x.runtime_metadata:
-                return m
+        index = self.indexed()
+        if index.last_runtime_metadata is not None:
+            return self[index.last_runtime_metadata].runtime_metadata
 
     def zero_time(self) -> datetime:
-        for x in self[::-1]:
+        for x in reversed(self):
             return datetime.fromisoformat(x.log_time) - timedelta(seconds=x.t)
         raise ValueError('Empty log')
 
     def is_completed(self) -> bool:
-        return any(
-            x.metadata.completed
-            for x in self
-        )
+        return self.indexed().completed
 
     def num_plates(self) -> int:
-        return max((int(p) for x in self if (p := x.metadata.plate_id)), default=0)
+        return max((int(p) for p in self.indexed().by_plate), default=0)
 
     def drop_validate(self) -> Log:
         res = self
-        res = res.drop(lambda e: isinstance(e.cmd, BiotekCmd) and e.cmd.action == 'Validate' and not e.metadata.gui_force_show)
+        res = res.drop(is_validate)
         return res
 
     def drop_test_comm(self) -> Log:
         res = self
-        res = res.drop(lambda e: isinstance(e.cmd, BiotekCmd) and e.cmd.action == 'TestCommunications' and not e.metadata.gui_force_show)
-        res = res.drop(lambda e: isinstance(e.cmd, IncuCmd) and e.cmd.action == 'get_status' and not e.metadata.gui_force_show)
+        res = res.drop(is_test_comm)
         return res
 
     def drop(self, p: Callable[[LogEntry], Any]) -> Log:
@@ -257,7 +533,152 @@ class Log(list[LogEntry]):
         )
 
     def drop_after(self, secs: float | int) -> Log:
+        index = self.indexed()
+        if index.t_sorted:
+            return Log(self[:bisect.bisect_right(index.ts, secs)])
         return Log([e for e in self if e.t <= secs])
 
 
+def is_validate(e: LogEntry) -> bool:
+    return isinstance(e.cmd, BiotekCmd) and e.cmd.action == 'Validate' and not e.metadata.gui_force_show
+
+def is_test_comm(e: LogEntry) -> bool:
+    if e.metadata.gui_force_show:
+        return False
+    match e.cmd:
+        case BiotekCmd():
+            return e.cmd.action == 'TestCommunications'
+        case IncuCmd():
+            return e.cmd.action == 'get_status'
+        case _:
+            return False
+
+def section_key(e: LogEntry) -> float:
+    '''
+    The order of entries in group_by_section
+    '''
+    return (e.t0 or e.t) if isinstance(e.cmd, BiotekCmd | IncuCmd | RobotarmCmd) else e.t
+
+def split_sections(xs: Iterable[LogEntry], first_section_name: str='begin') -> dict[str, Log]:
+    '''
+    Groups entries sorted by section_key into the sections they start.
+    Each section but the last ends just before the next one.
+    '''
+    ys = Log()
+    out = {first_section_name: ys}
+    for x in xs:
+        if section := x.metadata.section:
+            ys = Log()
+            out[section] = ys
+        ys.append(x)
+    if not out[first_section_name]:
+        out.pop(first_section_name)
+    out = {
+        k: v if not next_kv else Log(v + [LogEntry(t=next_kv[1].min_t() - 0.05)])
+        for (k, v), next_kv in utils.iterate_with_next(list(out.items()))
+    }
+    return out
+
+@dataclass
+class LogTail:
+    '''
+    Follows a log as it is appended to. Each read decodes only the lines
+    appended since the previous read and updates the views of the entries:
+    the same as finished(), errors(), num_plates() and so on of the log.
+    The file is read from the start again if it was truncated or replaced.
+
+    Only entries satisfying where are kept and seen by the views. The running
+    state is followed from all lines so that a running log can be tailed
+    without keeping its entries.
+
+    The entries the gui shows, the ends without test communications, are
+    also kept in section_key order, ready for split_sections.
+    '''
+    path: str
+    where: Callable[[LogEntry], bool] = lambda _: True
+
+    entries: Log = field(default_factory=Log)
+    finished: set[str] = field(default_factory=set[str])
+    errors: list[tuple[Error, LogEntry]] = field(default_factory=list[tuple[Error, LogEntry]])
+    section_order: list[LogEntry] = field(default_factory=list[LogEntry])
+    section_keys: list[float] = field(default_factory=list[float])
+    num_plates: int = 0
+    completed: bool = False
+    max_t: float = 0.0
+    runtime_metadata: RuntimeMetadata | None = None
+    running: Running | None = None
+
+    offset: int = 0
+    file_id: tuple[int, int] = (0, 0)
+    lock: RLock = field(default_factory=RLock)
+
+    def read(self) -> bool:
+        '''
+        Reads the complete lines appended since the last read. Returns whether there were any.
+        '''
+        with self.lock, open(self.path, 'rb') as f:
+            stat = os.fstat(f.fileno())
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self.file_id or stat.st_size < self.offset:
+                self.reset(file_id)
+            if stat.st_size == self.offset:
+                return False
+            f.seek(self.offset)
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            for line in data[:end].split(b'\n'):
+                if line.strip():
+                    x = utils.serializer.loads(line)
+                    assert isinstance(x, LogEntry)
+                    self.add(x)
+            self.offset += end
+            return end > 0
+
+    def reset(self, file_id: tuple[int, int]):
+        fresh = LogTail(self.path, self.where, lock=self.lock)
+        for f in fields(self):
+            setattr(self, f.name, getattr(fresh, f.name))
+        self.file_id = file_id
+
+    def add(self, x: LogEntry):
+        if x.running:
+            self.running = x.running
+        elif x.running_delta and self.running:
+            self.running = x.running_delta.apply(self.running)
+        if not self.where(x):
+            return
+        self.entries.append(x)
+        if x.is_end_or_inf() and (i := x.metadata.id):
+            self.finished.add(i)
+        if x.runtime_metadata:
+            self.runtime_metadata = x.runtime_metadata
+            self.errors = []
+        if x.err:
+            self.errors.append((x.err, x))
+        if p := x.metadata.plate_id:
+            self.num_plates = max(self.num_plates, int(p))
+        self.completed = self.completed or bool(x.metadata.completed)
+        self.max_t = max(self.max_t, x.t) if len(self.entries) > 1 else x.t
+        if x.is_end_or_inf() and not is_test_comm(x):
+            k = section_key(x)
+            i = bisect.bisect_right(self.section_keys, k)
+            self.section_keys.insert(i, k)
+            self.section_order.insert(i, x)
+
+def reversed_lines(f: BinaryIO, chunk_size: int = 1 << 16) -> Iterator[bytes]:
+    '''
+    The non-empty lines of a file from the last to the first
+    '''
+    pos = f.seek(0, os.SEEK_END)
+    rest = b''
+    while pos > 0:
+        start = max(0, pos - chunk_size)
+        f.seek(start)
+        lines = (f.read(pos - start) + rest).split(b'\n')
+        pos = start
+        rest = lines.pop(0) if pos > 0 else b''
+        for line in lines[::-1]:
+            if line.strip():
+                yield line
+
 utils.serializer.register(globals())
@@ -0,0 +1,156 @@
+'''
+Writes log entries to jsonl files from a dedicated thread
+
+The entries are serialized and written by the writer thread so that logging
+does not wait for the disk. Files that are replaced rather than appended to,
+such as snapshots, are written after the entries queued before them are
+flushed and only the last version in each batch is written. Each file is kept open and is flushed when the
+queue is empty, so readers such as the gui see the entries promptly. The fsync
+policy decides when the entries are made durable:
+
+    never:  leave it to the operating system
+    batch:  after each flush (default)
+    always: after each entry
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+import os
+import threading
+import traceback
+from queue import Queue
+
+from . import utils
+
+FsyncPolicy = Literal['never', 'batch', 'always']
+
+@dataclass
+class LogWriter:
+    fsync: FsyncPolicy = 'batch'
+    maxsize: int = 10000
+    queue: Queue[tuple[str, Any, bool] | None] = field(init=False)
+    files: dict[str, IO[bytes]] = field(default_factory=dict[str, IO[bytes]])
+    thread: threading.Thread | None = None
+    lock: threading.Lock = field(default_factory=threading.Lock)
+    error: BaseException | None = None
+
+    def __post_init__(self):
+        self.queue = Queue(maxsize=self.maxsize)
+
+    def write(self, path: str, entry: Any):
+        '''
+        Appends the entry to the file at path. Blocks only if the queue is full.
+        '''
+        self.raise_error()
+        self.start()
+        self.queue.put((path, entry, False))
+
+    def put(self, path: str, x: Any):
+        '''
+        Replaces the file at path with x as json.
+        '''
+        self.raise_error()
+        self.start()
+        self.queue.put((path, x, True))
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.loop, name='log writer', daemon=True)
+                self.thread.start()
+
+    def drain(self):
+        '''
+        Waits until all entries written so far are flushed.
+        '''
+        if self.thread is not None and self.thread.is_alive():
+            self.queue.join()
+        self.raise_error()
+
+    def raise_error(self):
+        '''
+        Raises the error recorded by the writer thread, once.
+        '''
+        with self.lock:
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def record_error(self, error: BaseException):
+        traceback.print_exc()
+        with self.lock:
+            if self.error is None:
+                self.error = error
+
+    def close(self):
+        with self.lock:
+            thread = self.thread
+            self.thread = None
+        if thread is not None and thread.is_alive():
+            self.queue.put(None)
+            thread.join()
+
+    def loop(self):
+        while True:
+            item = self.queue.get()
+            dirty: set[str] = set()
+            replaced: dict[str, Any] = {}
+            try:
+                while item is not None:
+                    path, x, replace = item
+                    if replace:
+                        replaced[path] = x
+                    else:
+                        try:
+                            self.append(path, x)
+                        except BaseException as e:
+                            self.record_error(e)
+                        dirty.add(path)
+                    if self.queue.empty():
+                        break
+                    self.queue.task_done()
+                    item = self.queue.get()
+                for path in dirty:
+                    try:
+                        self.flush(path, self.fsync != 'never')
+                    except BaseException as e:
+                        self.record_error(e)
+                for path, x in replaced.items():
+                    try:
+                        self.replace(path, x)
+                    except BaseException as e:
+                        self.record_error(e)
+                if item is None:
+                    for f in self.files.values():
+                        try:
+                            f.close()
+                        except BaseException as e:
+                            self.record_error(e)
+                    self.files.clear()
+                    return
+            finally:
+                self.queue.task_done()
+
+    def append(self, path: str, entry: Any):
+        f = self.files.get(path)
+        if f is None:
+            f = self.files[path] = open(path, 'ab')
+        f.write(utils.serializer.dumps(entry) + b'\n')
+        if self.fsync == 'always':
+            self.flush(path, True)
+
+    def replace(self, path: str, x: Any):
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(utils.serializer.dumps(x))
+            f.flush()
+            if self.fsync != 'never':
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def flush(self, path: str, fsync: bool):
+        if f := self.files.get(path):
+            f.flush()
+            if fsync:
+                os.fsync(f.fileno())
@@ -14,6 +14,7 @@ from functools import lru_cache
 
 from pathlib import Path
 from subprocess import Popen, DEVNULL
+import heapq
 import json
 import math
 import os
@@ -24,8 +25,9 @@ import re
 import shlex
 import textwrap
 import subprocess
+import threading
 
-from .log import Log, Running
+from .log import Log, LogTail, Running, is_validate, section_key, split_sections
 from .cli import Args
 
 from . import commands
@@ -152,20 +154,29 @@ def read_log_jsonl(filepath: str) -> Log:
     res = res.drop_validate()
     return res
 
-@lru_cache(maxsize=1)
-def _jsonl_to_log(path: str, mtime_ns: int) -> Log | None:
-    try:
-        return Log.read_jsonl(path).drop_validate()
-    except:
-        return None
+log_tails: dict[tuple[str, bool], LogTail] = {}
+log_tails_lock = threading.Lock()
 
-def jsonl_to_log(path: str) -> Log | None:
-    p = Path(path)
-    try:
-        stat = p.stat()
-    except FileNotFoundError:
-        return None
-    return _jsonl_to_log(path, stat.st_mtime_ns)
+def follow_log(path: str, running: bool=False) -> LogTail | None:
+    '''
+    The tail of an event log, without validations, or of a running log, only
+    following its running state. The most recently followed logs are kept.
+    The requests are served from several threads so the tails are read under a lock.
+    '''
+    key = (path, running)
+    with log_tails_lock:
+        tail = log_tails.pop(key, None)
+        if tail is None:
+            tail = LogTail(path, where=(lambda _: False) if running else (lambda e: not is_validate(e)))
+        log_tails[key] = tail
+        while len(log_tails) > 4:
+            log_tails.pop(next(iter(log_tails)))
+        try:
+            tail.read()
+        except:
+            log_tails.pop(key, None)
+            return None
+        return tail
 
 def pp_secs(secs: int | float, zero: str='0'):
     dt = timedelta(seconds=math.ceil(secs))
@@ -237,46 +248,55 @@ class AnalyzeResult:
         return not self.process_is_alive or self.errors
 
     @staticmethod
-    def init(m: Log, drop_after: float | None = None) -> AnalyzeResult | None:
-
-        completed = m.is_completed()
+    def init(tail: LogTail, drop_after: float | None = None) -> AnalyzeResult | None:
+
+        with tail.lock:
+            runtime_metadata = tail.runtime_metadata
+            if not runtime_metadata:
+                return None
+            zero_time = tail.entries.zero_time()
+            completed = tail.completed
+            max_t = tail.max_t
+            errors = [*tail.errors]
+            if drop_after is None:
+                finished_ids = {*tail.finished}
+                log_num_plates = tail.num_plates
+                section_order = [*tail.section_order]
+            else:
+                m = tail.entries.drop_after(drop_after)
+                finished_ids = m.finished()
+                log_num_plates = m.num_plates()
+                section_order = sorted(m.drop_test_comm().where(lambda e: e.is_end_or_inf()), key=section_key)
 
-        runtime_metadata = m.runtime_metadata()
-        if not runtime_metadata:
-            return None
-        zero_time = m.zero_time()
         t_now = (datetime.now() - zero_time).total_seconds()
 
-        if t_now < m.max_t():
-            t_now = m.max_t()
+        if t_now < max_t:
+            t_now = max_t
 
         if completed:
-            t_now = m.max_t() + 1
+            t_now = max_t + 1
 
         alive = process_is_alive(runtime_metadata.pid, runtime_metadata.log_filename)
 
         if not alive:
-            t_now = m.max_t() + 1
+            t_now = max_t + 1
 
-        errors = m.errors(current_runtime_only=True)
         if errors:
             t_now = Log(e for _, e in errors).max_t() + 1
 
-        running_log = Log.read_jsonl(runtime_metadata.running_log_filename)
-
         if drop_after is not None:
             t_now = drop_after
-            m = m.drop_after(drop_after)
-            running_log = running_log.drop_after(drop_after)
-
-        running = running_log.running()
+            running = Log.read_running(runtime_metadata.running_log_filename, drop_after)
+        elif running_tail := follow_log(runtime_metadata.running_log_filename, running=True):
+            running = running_tail.running
+        else:
+            running = None
         if not running:
             running = Running.empty()
 
         estimates = read_log_jsonl(runtime_metadata.estimates_filename)
-        num_plates = max(m.num_plates(), estimates.num_plates())
+        num_plates = max(log_num_plates, estimates.num_plates())
 
-        finished_ids = m.finished()
         running_ids = Log(running.entries).ids()
         live_ids = finished_ids | running_ids
 
@@ -294,12 +314,13 @@ class AnalyzeResult:
         estimates = estimates.where(lambda e: e.metadata.id not in live_ids)
         estimates = estimates.add(Metadata(is_estimate=True))
 
-        vis = Log(m + running_entries + estimates)
-        vis = vis.drop_test_comm()
-        vis = vis.where(lambda e: e.is_end_or_inf())
-        end = LogEntry(t=vis.max_t(), metadata=Metadata(section='end'))
-        vis = Log(vis + [end])
-        sections = vis.group_by_section()
+        # the entries of the log are already in order, only these are sorted
+        extra = Log(running_entries + estimates)
+        extra = extra.drop_test_comm()
+        extra = extra.where(lambda e: e.is_end_or_inf())
+        vis = [*heapq.merge(section_order, sorted(extra, key=section_key), key=section_key)]
+        end = LogEntry(t=max((e.t for e in vis), default=0.0), metadata=Metadata(section='end'))
+        sections = split_sections([*vis, end])
 
         return AnalyzeResult(
             zero_time=zero_time,
@@ -960,25 +981,26 @@ def index(path: str | None = None) -> Iterator[Tag | V.Node | dict[str, str]]:
 
     t_end_form: div | None = None
     if path:
-        log = jsonl_to_log(path)
+        tail = follow_log(path)
         try:
             stderr = as_stderr(path).read_text()
         except:
             stderr = ''
-        if log is not None:
-            ar = AnalyzeResult.init(log)
-        if log and ar and ar.completed and 'dry' in config.name:
-            t_min = int(log.min_t()) + 1
-            t_max = int(log.max_t()) + 1
-            t_end = m.var(Int(t_max, type='range', min=t_min, max=t_max))
-            t_end_form = div(
-                div(*form(m, t_end),
-                    str(timedelta(seconds=t_end.value)),
-                    css=inverted_inputs_css,
-                    css_='& input { width: 700px; }'),
-                margin='0 auto',
-            )
-            ar = AnalyzeResult.init(log, drop_after=float(t_end.value))
+        if tail is not None:
+            log = tail.entries
+            ar = AnalyzeResult.init(tail)
+            if log and ar and ar.completed and 'dry' in config.name:
+                t_min = int(log.min_t()) + 1
+                t_max = int(tail.max_t) + 1
+                t_end = m.var(Int(t_max, type='range', min=t_min, max=t_max))
+                t_end_form = div(
+                    div(*form(m, t_end),
+                        str(timedelta(seconds=t_end.value)),
+                        css=inverted_inputs_css,
+                        css_='& input { width: 700px; }'),
+                    margin='0 auto',
+                )
+                ar = AnalyzeResult.init(tail, drop_after=float(t_end.value))
     if log is None:
         if stderr:
             box = div(
@@ -40,9 +40,8 @@ def visualize_modules(out_path: str='cellpainter.dot'):
         ProtocolConfig
 
         Timelike
-        SimulatedTime
+        EventTime
         WallTime
-        ThreadData
     '''.split()
     for m in ms:
         for k, v in m.__dict__.items():
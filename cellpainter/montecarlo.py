@@ -0,0 +1,121 @@
+'''
+Monte Carlo simulation of a scheduled program
+
+The resolved program is run many times in simulated time like the dry run,
+but the duration of each timed command is drawn from its timings in
+estimates.json. The runs are spread over worker processes and summarized as
+distributions of the makespan, the number of waits that were behind time and
+the incubation deviations per plate.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+import io
+import os
+import random
+
+from . import utils
+from .commands import Command, WaitForCheckpoint
+from .estimates import EstCmd, incubation_deviations, percentile, sample_timings
+from .log import Log
+from .runtime import Runtime, dry_run
+from .timelike import EventTime
+
+@dataclass
+class SampledTime(EventTime):
+    '''
+    EventTime where timed commands take a duration drawn from their timings
+    '''
+    rng: random.Random = field(default_factory=random.Random)
+
+    def duration(self, cmd: Any, est: float) -> float:
+        assert isinstance(cmd, EstCmd)
+        if times := sample_timings(cmd):
+            return self.rng.choice(times)
+        else:
+            return est
+
+@dataclass(frozen=True)
+class Sample:
+    makespan: float = 0.0
+    behind: int = 0
+    incu_deviation: dict[str, float] = field(default_factory=dict[str, float])
+    error: str = ''
+
+def sample_stats(log: Log) -> Sample:
+    behind = [
+        x
+        for x in log
+        if isinstance(x.cmd, WaitForCheckpoint)
+        if x.cmd.report_behind_time
+        if x.is_end()
+        if (s := x.metadata.sleep_secs) is not None and s <= -0.1
+    ]
+    incu_deviation: dict[str, float] = {}
+    for x, deviation in incubation_deviations(log):
+        plate = x.metadata.plate_id or ''
+        incu_deviation[plate] = max(incu_deviation.get(plate, 0.0), round(deviation, 3))
+    return Sample(
+        makespan=log.max_t(),
+        behind=len(behind),
+        incu_deviation=incu_deviation,
+    )
+
+def run_sample(program: Command, seed: int) -> Sample:
+    from .execute import simulate
+    config = dry_run.replace(log_to_file=False)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            runtime = Runtime(config=config, timelike=SampledTime(rng=random.Random(seed)))
+            simulate(program, runtime)
+        return sample_stats(runtime.get_log())
+    except Exception as e:
+        return Sample(error=repr(e))
+
+def run_samples(program: Command, seeds: list[int]) -> list[Sample]:
+    return [run_sample(program, seed) for seed in seeds]
+
+@dataclass(frozen=True)
+class MonteCarlo:
+    samples: list[Sample]
+
+    def report(self) -> list[str]:
+        ok = [s for s in self.samples if not s.error]
+        errors = utils.group_by([s.error for s in self.samples if s.error], key=lambda e: e)
+        lines = [f'runs: {len(self.samples)}']
+        for error, es in errors.items():
+            lines += [f'  {len(es)} failed: {error}']
+        if not ok:
+            return lines
+        makespans = [s.makespan for s in ok]
+        behind = [s.behind for s in ok]
+        lines += [
+            'makespan:',
+            *(
+                f'  p{p:<3} {utils.pp_secs(percentile(makespans, p))}'
+                for p in [50, 90, 99]
+            ),
+            f'waits behind time: mean {sum(behind) / len(ok):.2f}, in {sum(1 for b in behind if b) / len(ok):.1%} of runs',
+            'incubation deviation per plate (p50 p90 max seconds):',
+        ]
+        plates = sorted({p for s in ok for p in s.incu_deviation}, key=lambda p: (len(p), p))
+        for plate in plates:
+            ds = [s.incu_deviation[plate] for s in ok if plate in s.incu_deviation]
+            lines += [f'  plate {plate:>2} {percentile(ds, 50):8.1f} {percentile(ds, 90):8.1f} {max(ds):8.1f}']
+        return lines
+
+def montecarlo(program: Command, runs: int = 1000, seed: int = 0, max_workers: int | None = None) -> MonteCarlo:
+    '''
+    Simulates the resolved program runs times. Each run has its own seed so the
+    result does not depend on how the runs are spread over the workers.
+    '''
+    seeds = [seed + i for i in range(runs)]
+    workers = max_workers or os.cpu_count() or 1
+    chunks = [seeds[i::workers] for i in range(workers)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_samples, program, chunk) for chunk in chunks if chunk]
+        samples = [s for f in futures for s in f.result()]
+    return MonteCarlo(samples)
@@ -64,7 +64,7 @@ def poll() -> None:
                 q = [r2d_round(q[0]), r2d_round(q[1]), r2d_round(q[2]), r2d_round(q[3]), r2d_round(q[4]), r2d_round(q[5])]
                 tick = 1 + read_output_integer_register(1)
                 write_output_integer_register(1, tick)
-                textmsg("poll {" +
+                textmsg("log poll {" +
                     "'xyz': " + to_str(xyz) + ", " +
                     "'rpy': " + to_str(rpy) + ", " +
                     "'joints': " + to_str(q) + ", " +
@@ -73,10 +73,10 @@ def poll() -> None:
                 "} eom")
             end
         '''))
-        for b in arm.recv():
-            if m := re.search(rb'poll (.*\}) eom', b):
+        for event in arm.recv():
+            if m := re.search(r'poll (.*\}) eom', event.text):
                 try:
-                    v = m.group(1).decode(errors='replace')
+                    v = m.group(1)
                     prev = polled_info.copy()
                     polled_info.update(ast.literal_eval(v))
                     if prev != polled_info:
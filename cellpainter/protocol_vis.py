@@ -9,6 +9,7 @@ from .utils.provenance import Store, Str, Int
 
 from .log import Log
 from . import commands
+from . import critical_path
 
 from collections import *
 
@@ -175,6 +176,9 @@ def start(cmdline0: str, cmdline_to_log: Callable[[str], Log]):
             fg_color = '#000'
             if color == colors.get('color4'):
                 fg_color = '#fff'
+            border_color = '#0005'
+            if m.slack is not None and m.slack < critical_path.Tolerance and source != 'duration':
+                border_color = '#e00'
             width = 14
             my_width = 14
             my_offset = 0
@@ -211,7 +215,7 @@ def start(cmdline0: str, cmdline_to_log: Callable[[str], Log]):
                 css='''
                     position: absolute;
                     border-radius: 2px;
-                    border: 1px #0005 solid;
+                    border: 1px var(--border-color) solid;
                     display: grid;
                     place-items: center;
                     font-size: 12px;
@@ -247,6 +251,7 @@ def start(cmdline0: str, cmdline_to_log: Callable[[str], Log]):
                 css__=f'''
                     --bg-color: {color};
                     --fg-color: {fg_color};
+                    --border-color: {border_color};
                 ''',
                 style=trim(f'''
                     left: {slot * width + my_offset:.1f}px;
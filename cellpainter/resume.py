@@ -1,9 +1,11 @@
 from __future__ import annotations
 from dataclasses import *
+from typing import Any
 
 from . import utils
 import shutil
 import os
+import sys
 from .commands import (
     Checkpoint,
     WaitForCheckpoint,
@@ -18,13 +20,18 @@ from .commands import (
 from .moves import InitialWorld
 from .runtime import RuntimeConfig, ResumeConfig
 from .execute import execute_program
+from . import constraints
 from . import moves
-from .log import Log
+from .log import Log, Snapshot, snapshot_filename
 
-def execute_resume(config: RuntimeConfig, log_filename_in: str, resume_time_now: str | None = None, skip: list[str]=[], drop: list[str]=[]):
-    entries = Log.read_jsonl(log_filename_in)
+def execute_resume(config: RuntimeConfig, log_filename_in: str, resume_time_now: str | None = None, skip: list[str]=[], drop: list[str]=[], strict: bool = False):
+    snapshot = Snapshot.read(log_filename_in)
+    resume_config = ResumeConfig.from_snapshot(snapshot, resume_time_now)
 
-    program = resume_program(entries, skip=skip, drop=drop)
+    program = resume_program(snapshot, skip=skip, drop=drop)
+    schedule: dict[str, Any] | None = None
+    if rescheduled := reschedule(snapshot, resume_config, skip=skip, drop=drop, strict=strict):
+        program, schedule = rescheduled
 
     log_filename = config.log_filename
     if not log_filename:
@@ -34,30 +41,93 @@ def execute_resume(config: RuntimeConfig, log_filename_in: str, resume_time_now:
     os.makedirs(os.path.dirname(abspath), exist_ok=True)
     print(f'{log_filename=}')
     shutil.copy2(log_filename_in, log_filename)
+    if os.path.exists(snapshot_filename(log_filename_in)):
+        shutil.copy2(snapshot_filename(log_filename_in), snapshot_filename(log_filename))
 
     config = config.replace(
         log_filename=log_filename,
-        resume_config=ResumeConfig.init(entries, resume_time_now)
+        resume_config=resume_config,
     )
-    execute_program(config, program, {})
-
-def resume_program(entries: Log, skip: list[str]=[], drop: list[str]=[]):
-
-    program: Command | None = None
-    runtime_metadata = entries.runtime_metadata()
+    execute_program(config, program, {}, schedule=schedule)
+
+def reschedule(snapshot: Snapshot, resume_config: ResumeConfig, skip: list[str]=[], drop: list[str]=[], strict: bool = False) -> tuple[Command, dict[str, Any]] | None:
+    '''
+    Solves the rest of the program again from the schedule saved by the resumed run
+    so that its waits account for the time that has passed. The checkpoints that have
+    happened are fixed and the previous schedule is the initial guess.
+
+    The checkpoints of dropped plates are not fixed since their commands are gone.
+    If the solve fails with the previous schedule as initial guess it is solved
+    again without it. Returns None if there is no saved schedule or, with a warning,
+    if the rest cannot be scheduled. With strict it raises instead of returning None.
+    '''
+    constraints.import_z3()
+    from z3 import Z3Exception # type: ignore
+
+    runtime_metadata = snapshot.runtime_metadata
     assert runtime_metadata
-    program = utils.serializer.read_json(runtime_metadata.program_filename)
+    if not runtime_metadata.schedule_filename:
+        return None
+    saved: dict[str, Any] = utils.serializer.read_json(runtime_metadata.schedule_filename)
+    dropped: set[str] = {
+        c.name
+        for cmd in saved['program'].universe()
+        if isinstance(cmd, Meta) and cmd.metadata.plate_id in drop
+        for c in cmd.universe()
+        if isinstance(c, Checkpoint)
+    }
+    program = resume_program(snapshot, skip=skip, drop=drop, program=saved['program'])
+    warm = constraints.WarmStart(
+        start=resume_config.secs_ago,
+        checkpoint_times={
+            name: t
+            for name, t in resume_config.checkpoint_times.items()
+            if name not in dropped
+        },
+        env={
+            name: v
+            for name, v in saved['env'].items()
+            if name not in dropped
+        },
+    )
+    for w in [warm, replace(warm, env={})] if warm.env else [warm]:
+        try:
+            with utils.timeit('reschedule') as info:
+                resolved, opt = constraints.optimize(program, warm=w)
+                info.update(opt.stats)
+            return resolved, {'program': program, 'env': opt.env}
+        except (AssertionError, constraints.ScheduleTimeout, Z3Exception) as e:
+            if w.env:
+                print('Could not reschedule from the previous schedule, solving without it:', e)
+            elif strict:
+                raise ValueError(f'Could not reschedule: {e}') from e
+            else:
+                print('Warning: could not reschedule, resuming with the previous schedule:', e, file=sys.stderr)
+    return None
+
+def resume_program(snapshot: Snapshot, skip: list[str]=[], drop: list[str]=[], program: Command | None = None) -> Command:
+    '''
+    The rest of the program of the snapshot. By default the program is the one that was run.
+    '''
+    runtime_metadata = snapshot.runtime_metadata
+    assert runtime_metadata
+    if program is None:
+        program = utils.serializer.read_json(runtime_metadata.program_filename)
+        assert program and isinstance(program, Command)
+        if snapshot.next_id and snapshot.program_hash == Snapshot.hash_program(runtime_metadata.program_filename):
+            next_id = snapshot.next_id
+        else:
+            next_id = program.next_id()
+    else:
+        next_id = program.next_id()
     assert program and isinstance(program, Command)
 
-    next_id = program.next_id()
     def get_fresh_id():
         nonlocal next_id
         next_id += 1
         return str(next_id)
 
-    running_log = Log.read_jsonl(runtime_metadata.running_log_filename)
-    running = running_log.running()
-    utils.pr(running_log)
+    running = Log.read_running(runtime_metadata.running_log_filename)
     assert running
     resumed_world = {
         location: thing
@@ -72,14 +142,15 @@ def resume_program(entries: Log, skip: list[str]=[], drop: list[str]=[]):
 
     resumed_world_cmd = Info('resumed world').add(Metadata(effect=InitialWorld(resumed_world), id=get_fresh_id()))
 
-    remove_ids: set[str] = entries.finished()
+    remove_ids: set[str] = {*snapshot.finished}
 
     drop_ids: set[str] = set()
-    for cmd in program.universe():
-        if isinstance(cmd, Meta) and cmd.metadata.plate_id in drop:
-            for c2 in cmd.universe():
-                if isinstance(c2, Meta) and c2.metadata.id:
-                    drop_ids.add(c2.metadata.id)
+    if drop:
+        for cmd in program.universe():
+            if isinstance(cmd, Meta) and cmd.metadata.plate_id in drop:
+                for c2 in cmd.universe():
+                    if isinstance(c2, Meta) and c2.metadata.id:
+                        drop_ids.add(c2.metadata.id)
     remove_ids |= drop_ids
 
     robotarm_prep_cmds: list[Command] = [
@@ -98,7 +169,7 @@ def resume_program(entries: Log, skip: list[str]=[], drop: list[str]=[]):
                 ]
             break
 
-    checkpoint_times: dict[str, float] = entries.checkpoints()
+    checkpoint_times: dict[str, float] = snapshot.checkpoint_times
 
     def FixupForkMetadataBeforeFilter(cmd: Command):
         '''
@@ -118,12 +189,20 @@ def resume_program(entries: Log, skip: list[str]=[], drop: list[str]=[]):
                     return Sequence()
                 else:
                     return cmd
+            case Fork() if cmd.thread_name in checkpoint_times:
+                # make_resource_checkpoints names each forked thread after the checkpoint
+                # at its end, so this thread has finished. Only commands that are not
+                # logged can remain in it, such as scheduling idles, and they go too.
+                return Sequence()
             case Meta() if cmd.metadata.id in remove_ids:
                 return Sequence()
             case Meta() if cmd.metadata.simple_id in skip:
                 return Sequence()
             case WaitForCheckpoint() if not cmd.plus_secs and cmd.name in checkpoint_times:
                 return Sequence()
+            case WaitForCheckpoint() if drop and cmd.assume == 'no wait':
+                # the dropped commands might have been what made the wait unnecessary
+                return cmd.replace(assume='nothing')
             case _:
                 return cmd
 
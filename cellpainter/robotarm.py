@@ -6,7 +6,11 @@ from typing import *
 from .moves import Move
 
 import re
+import select
 import socket
+import textwrap
+import threading
+from functools import lru_cache
 from . import gripper
 
 prelude = '''
@@ -144,6 +148,13 @@ def reindent(s: str) -> str:
             i += 2
     return '\n'.join(out) + '\n'  # final newline required when sending on socket
 
+@lru_cache
+def library(with_gripper: bool) -> str:
+    '''
+    The prelude and gripper code, reindented once and shared by all scripts.
+    '''
+    return textwrap.indent(reindent(prelude + '\n' + gripper_code(with_gripper)), '  ')
+
 def make_script(movelist: list[Move], with_gripper: bool, name: str='script') -> str:
     body = '\n'.join(
         ("# " + getattr(m, 'name') + '\n' if hasattr(m, 'name') else '')
@@ -152,14 +163,30 @@ def make_script(movelist: list[Move], with_gripper: bool, name: str='script') ->
     )
     assert re.match(r'(?!\d)\w*$', name)
     assert len(name) <= 30
-    return reindent(f'''
-        def {name}():
-            {prelude}
-            {gripper_code(with_gripper)}
+    return (
+        f'def {name}():\n'
+        + library(with_gripper)
+        + textwrap.indent(reindent(f'''
             {body}
             textmsg("log {name} done")
-        end
-    ''')
+        '''), '  ')
+        + 'end\n'
+    )
+
+compiled_scripts: dict[tuple[str, bool], tuple[list[Move], bytes]] = {}
+
+def compile_script(movelist: list[Move], with_gripper: bool, name: str='script') -> bytes:
+    '''
+    The encoded script, cached by name. It is compiled again if the movelist
+    has changed since, for example when its file has been edited and read again.
+    '''
+    key = (name, with_gripper)
+    cached = compiled_scripts.get(key)
+    if cached is not None and cached[0] == movelist:
+        return cached[1]
+    script = make_script(movelist, with_gripper, name=name).encode()
+    compiled_scripts[key] = (list(movelist), script)
+    return script
 
 @dataclass(frozen=True)
 class Robotarm:
@@ -180,32 +207,57 @@ class Robotarm:
     sock: socket.socket | Literal['noop']
     quiet: bool = False
 
-    def send(self, prog_str: str) -> Robotarm:
-        prog_bytes = prog_str.encode()
+    def send(self, prog_str: str | bytes) -> Robotarm:
+        prog_bytes = prog_str.encode() if isinstance(prog_str, str) else prog_str
         if self.sock == 'noop':
             return self
         # print(prog_str)
         self.sock.sendall(prog_bytes)
         return self
 
-    def recv(self) -> Iterator[bytes]:
+    def recv(self, timeout: float | None = None) -> Iterator[RobotarmEvent]:
+        '''
+        The messages from the robot arm as they complete. Raises TimeoutError if
+        the robot arm sends nothing for timeout seconds.
+        '''
         if self.sock == 'noop':
             raise RuntimeError
+        parser = ResponseParser()
+        for event in self.recv_parsed(parser, timeout):
+            if event is not None:
+                yield event
+
+    def recv_parsed(self, parser: ResponseParser, timeout: float | None = None) -> Iterator[RobotarmEvent | None]:
+        '''
+        Feeds the parser and yields its events, and None after each read.
+        '''
+        assert self.sock != 'noop'
         while True:
+            if timeout is not None:
+                ready, _, _ = select.select([self.sock], [], [], timeout)
+                if not ready:
+                    raise TimeoutError(f'nothing received from robotarm in {timeout}s')
             data = self.sock.recv(4096)
-            for m in re.findall(rb'[\x20-\x7e]*(?:log|program|assert|\w+exception|error|\w+_\w+:)[\x20-\x7e]*', data, re.IGNORECASE):
-                m = m.decode()
-                self.quiet or print(f'{m = }')
-                if 'panic' in m:
+            if not data:
+                raise ConnectionResetError('robotarm closed the connection')
+            for event in parser.feed(data):
+                self.quiet or print(f'{event.kind}: {event.text}')
+                if 'panic' in event.text:
                     self.sock.sendall('textmsg("panic stop")\n'.encode())
-                    raise RuntimeError(m)
-            yield data
+                    raise RuntimeError(event.text)
+                yield event
+            yield None
 
-    def recv_until(self, needle: str) -> None:
+    def recv_until(self, needle: str, timeout: float | None = None) -> None:
+        '''
+        Waits for a message containing needle. The needle is also found in a
+        message that is not yet complete, so that waiting ends as soon as it arrives.
+        '''
         if self.sock == 'noop':
             return
-        for data in self.recv():
-            if needle.encode() in data:
+        parser = ResponseParser()
+        for event in self.recv_parsed(parser, timeout):
+            if needle in (parser.pending() if event is None else event.text):
                 self.quiet or print(f'received {needle}')
                 return
 
@@ -233,13 +285,149 @@ class Robotarm:
         self.recv_until('quit')
 
     def execute_moves(self, movelist: list[Move], name: str='script', allow_partial_completion: bool=False) -> None:
-        name = name.replace('/', '_of_')
-        name = name.replace(' ', '_')
-        name = name.replace('-', '_')
-        name = name[:30]
-        self.send(make_script(movelist, self.with_gripper, name=name))
+        name = script_name(name)
+        self.send(compile_script(movelist, self.with_gripper, name=name))
+        self.wait_for_script(name, allow_partial_completion)
+
+    def wait_for_script(self, name: str, allow_partial_completion: bool=False) -> None:
         if allow_partial_completion:
             self.recv_until(f'PROGRAM_XXX_STOPPED{name}')
         else:
             self.recv_until(f'log {name} done')
 
+RobotarmEventKind = Literal['log', 'error', 'exception', 'stopped', 'message']
+
+@dataclass(frozen=True)
+class RobotarmEvent:
+    kind: RobotarmEventKind
+    text: str
+
+    @staticmethod
+    def classify(text: str) -> RobotarmEvent:
+        lower = text.lower()
+        if 'program_xxx_stopped' in lower:
+            kind = 'stopped'
+        elif re.search(r'\wexception', lower):
+            kind = 'exception'
+        elif 'error' in lower:
+            kind = 'error'
+        elif 'log' in lower:
+            kind = 'log'
+        else:
+            kind = 'message'
+        return RobotarmEvent(kind, text)
+
+@dataclass
+class ResponseParser:
+    '''
+    Parses the output of the primary interface incrementally.
+
+    The messages are the runs of printable characters between the binary parts
+    of the stream. A run that continues at the end of a read is carried over to
+    the next read, keeping at most max_carry bytes, so that a message split over
+    two reads is seen whole. Only runs that look like messages become events.
+    '''
+    max_carry: int = 4096
+    carry: bytes = b''
+
+    printable: ClassVar = re.compile(rb'[\x20-\x7e]+')
+    interesting: ClassVar = re.compile(r'log|program|assert|\wexception|error|\w_\w+:', re.IGNORECASE)
+
+    def feed(self, data: bytes) -> list[RobotarmEvent]:
+        data = self.carry + data
+        events: list[RobotarmEvent] = []
+        carry_from = len(data)
+        for m in self.printable.finditer(data):
+            if m.end() == len(data):
+                carry_from = m.start()
+                break
+            text = m.group().decode()
+            if self.interesting.search(text):
+                events += [RobotarmEvent.classify(text)]
+        self.carry = data[carry_from:][-self.max_carry:]
+        return events
+
+    def pending(self) -> str:
+        '''
+        The message that is not yet complete, if any.
+        '''
+        return self.carry.decode()
+
+def script_name(name: str) -> str:
+    name = name.replace('/', '_of_')
+    name = name.replace(' ', '_')
+    name = name.replace('-', '_')
+    name = name[:30]
+    return name
+
+@dataclass
+class RobotarmConnection:
+    '''
+    A long-lived connection to the robot arm shared by the commands of a run.
+
+    It is opened on first use and checked before each script is sent: output
+    buffered since the last script is discarded and a closed connection is
+    reopened. A script that could not be sent is sent again on a new connection
+    but a script that has started is never sent again.
+    '''
+    host: str
+    port: int
+    quiet: bool = True
+    arm: Robotarm | None = None
+    lock: threading.RLock = field(default_factory=threading.RLock)
+
+    def connect(self) -> Robotarm:
+        with self.lock:
+            if self.arm is None:
+                self.arm = Robotarm.init(self.host, self.port, with_gripper=False, quiet=self.quiet)
+            return self.arm
+
+    def healthy(self) -> bool:
+        with self.lock:
+            if self.arm is None or self.arm.sock == 'noop':
+                return self.arm is not None
+            sock = self.arm.sock
+            try:
+                while select.select([sock], [], [], 0)[0]:
+                    if not sock.recv(1 << 16):
+                        return False
+            except OSError:
+                return False
+            return True
+
+    def close(self) -> None:
+        with self.lock:
+            if self.arm is not None:
+                self.arm.close()
+                self.arm = None
+
+    def send(self, prog_str: str | bytes) -> Robotarm:
+        '''
+        Sends the program on a healthy connection and returns the arm to receive its output from.
+        '''
+        with self.lock:
+            if not self.healthy():
+                self.close()
+            try:
+                return self.connect().send(prog_str)
+            except OSError:
+                self.close()
+                return self.connect().send(prog_str)
+
+    def set_speed(self, value: int) -> None:
+        with self.lock:
+            if not self.healthy():
+                self.close()
+            self.connect().set_speed(value)
+
+    def execute_moves(self, movelist: list[Move], name: str='script', with_gripper: bool=False, allow_partial_completion: bool=False) -> None:
+        name = script_name(name)
+        script = compile_script(movelist, with_gripper, name=name)
+        with self.lock:
+            arm = self.send(script)
+            try:
+                arm.wait_for_script(name, allow_partial_completion)
+            except OSError:
+                self.close()
+                raise
+
@@ -0,0 +1,306 @@
+'''
+A stand-in for the robot arm controller
+
+Serves enough of the primary interface that Robotarm uses to run the execute
+path against a plain socket: scripts are received and run one at a time, a new
+program replaces the running one, textmsg calls are sent back as messages and
+PROGRAM_XXX_STOPPED is reported when a program ends. Secondary programs run
+alongside. The messages are framed as robot message packets between robot
+state packets so the stream looks like the real one to the parser.
+
+URScript is not interpreted. The top-level statements of a program are
+recognized and MoveLin, MoveRel and MoveJoint take the time of a trapezoidal
+velocity profile over their distance with the speeds and accelerations of the
+prelude. Joint and linear positions are tracked separately, so a linear move
+after a joint move is timed from the last linear position. Latency is added
+before each message and a program fails with probability fail_rate by closing
+the connection it came from partway through.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+import ast
+import math
+import random
+import re
+import socket
+import struct
+import threading
+import time
+
+RobotState = 16
+RobotMessage = 20
+
+def packet(kind: int, payload: bytes) -> bytes:
+    return struct.pack('>iB', 5 + len(payload), kind) + payload
+
+def text_packet(text: str) -> bytes:
+    timestamp = int(time.time() * 1000)
+    return packet(RobotMessage, struct.pack('>qbB', timestamp, -1, 0) + text.encode())
+
+def travel_time(dist: float, v: float, a: float) -> float:
+    '''
+    The time to move dist with top speed v and acceleration a, starting and ending at rest.
+    '''
+    if dist < v * v / a:
+        return 2 * math.sqrt(dist / a)
+    else:
+        return dist / v + v / a
+
+@dataclass(frozen=True)
+class Program:
+    name: str
+    lines: list[str]
+    secondary: bool = False
+    conn: socket.socket | None = None
+
+    def statements(self) -> list[ast.Call]:
+        '''
+        The calls at the top level of the program, not inside nested definitions.
+        '''
+        out: list[ast.Call] = []
+        depth = 0
+        skip_until: int | None = None
+        for line in self.lines:
+            if line == 'end' or line.startswith('end '):
+                depth -= 1
+                if depth == skip_until:
+                    skip_until = None
+                continue
+            if skip_until is None and not line.startswith('#'):
+                if line.startswith('def ') and line.endswith(':'):
+                    skip_until = depth
+                else:
+                    out += [
+                        node.value
+                        for node in parse_statement(line)
+                        if isinstance(node, ast.Expr) and isinstance(node.value, ast.Call)
+                    ]
+            if line.endswith(':') and not line.startswith('#') and not line.startswith(('elif', 'else')):
+                depth += 1
+        return out
+
+def parse_statement(line: str) -> list[ast.stmt]:
+    try:
+        return ast.parse(line.rstrip(':')).body
+    except SyntaxError:
+        return []
+
+def call_name(call: ast.Call) -> str:
+    return call.func.id if isinstance(call.func, ast.Name) else ''
+
+def call_args(call: ast.Call) -> tuple[list[Any], dict[str, Any]]:
+    def value(node: ast.expr) -> Any:
+        try:
+            return ast.literal_eval(node)
+        except ValueError:
+            return None
+    return [value(a) for a in call.args], {k.arg or '': value(k.value) for k in call.keywords}
+
+def text_of(call: ast.Call) -> str:
+    return ''.join(
+        node.value
+        for node in ast.walk(call)
+        if isinstance(node, ast.Constant) and isinstance(node.value, str)
+    )
+
+def split_programs(text: str) -> tuple[list[list[str]], str]:
+    '''
+    Splits complete programs off the start of text and returns them with the rest.
+    '''
+    programs: list[list[str]] = []
+    current: list[str] = []
+    depth = 0
+    *lines, rest = text.split('\n')
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        current += [line]
+        if line == 'end' or line.startswith('end '):
+            depth -= 1
+        elif line.endswith(':') and not line.startswith('#') and not line.startswith(('elif', 'else')):
+            depth += 1
+        if depth <= 0:
+            programs += [current]
+            current = []
+            depth = 0
+    rest = '\n'.join(current + [rest]) if current else rest
+    return programs, rest
+
+@dataclass
+class RobotarmStandin:
+    host: str = 'localhost'
+    port: int = 30001
+    time_scale: float = 1.0
+    latency: float = 0.0
+    fail_rate: float = 0.0
+    state_interval: float = 0.1
+    seed: int | None = None
+    quiet: bool = True
+
+    speed: float = 1.0
+    xyz: list[float] | None = None
+    joints: list[float] | None = None
+    clients: list[socket.socket] = field(default_factory=list[socket.socket])
+    running: tuple[Program, threading.Event, threading.Thread] | None = None
+    lock: threading.RLock = field(default_factory=threading.RLock)
+    rng: random.Random = field(init=False)
+    server: socket.socket | None = None
+
+    def __post_init__(self):
+        self.rng = random.Random(self.seed)
+
+    def serve_forever(self):
+        self.server = socket.create_server((self.host, self.port))
+        if not self.quiet:
+            print(f'robotarm stand-in listening on {self.host}:{self.port}')
+        threading.Thread(target=self.send_states, daemon=True).start()
+        while True:
+            try:
+                conn, _ = self.server.accept()
+            except OSError:
+                return
+            with self.lock:
+                self.clients += [conn]
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def start(self) -> RobotarmStandin:
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        while self.server is None:
+            time.sleep(0.01)
+        self.port = self.server.getsockname()[1]
+        return self
+
+    def shutdown(self):
+        with self.lock:
+            if self.server:
+                self.server.close()
+            clients = [*self.clients]
+        for conn in clients:
+            self.disconnect(conn)
+
+    def handle(self, conn: socket.socket):
+        text = ''
+        while True:
+            try:
+                data = conn.recv(1 << 16)
+            except OSError:
+                data = b''
+            if not data:
+                self.disconnect(conn)
+                return
+            programs, text = split_programs(text + data.decode(errors='replace'))
+            for lines in programs:
+                self.run(self.program(lines, conn))
+
+    def disconnect(self, conn: socket.socket):
+        with self.lock:
+            if conn in self.clients:
+                self.clients.remove(conn)
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+            conn.close()
+        except OSError:
+            pass
+
+    def program(self, lines: list[str], conn: socket.socket) -> Program:
+        if m := re.match(r'(def|sec) (\w+)\(\):$', lines[0]):
+            return Program(m.group(2), lines[1:-1], secondary=m.group(1) == 'sec', conn=conn)
+        else:
+            return Program('unnamed', lines, conn=conn)
+
+    def run(self, program: Program):
+        if not self.quiet:
+            print(f'running {program.name}')
+        stop = threading.Event()
+        thread = threading.Thread(target=self.execute, args=(program, stop), daemon=True)
+        if program.secondary:
+            thread.start()
+            return
+        with self.lock:
+            running = self.running
+            self.running = (program, stop, thread)
+        if running:
+            _, running_stop, running_thread = running
+            running_stop.set()
+            running_thread.join()
+        thread.start()
+
+    def execute(self, program: Program, stop: threading.Event):
+        calls = program.statements()
+        fail_at = self.rng.randrange(len(calls) + 1) if self.rng.random() < self.fail_rate else None
+        for i, call in enumerate(calls):
+            if stop.is_set():
+                break
+            if i == fail_at and program.conn:
+                if not self.quiet:
+                    print(f'failing {program.name}')
+                self.disconnect(program.conn)
+                break
+            secs = self.step(call)
+            if secs > 0 and stop.wait(secs * self.time_scale):
+                break
+        if not program.secondary:
+            self.emit(f'PROGRAM_XXX_STOPPED{program.name}')
+            with self.lock:
+                if self.running and self.running[0] is program:
+                    self.running = None
+
+    def step(self, call: ast.Call) -> float:
+        '''
+        Carries out the effect of the call and returns how long it takes.
+        '''
+        args, kws = call_args(call)
+        slow = bool(kws.get('slow'))
+        match call_name(call):
+            case 'MoveLin' | 'MoveRel' if len(args) == 6 and None not in args:
+                xyz = args[:3]
+                if call_name(call) == 'MoveRel':
+                    xyz = [a + b for a, b in zip(self.xyz or [0.0, 0.0, 0.0], xyz)]
+                dist = math.dist(self.xyz or xyz, xyz) / 1000
+                self.xyz = xyz
+                v, a = (0.10, 0.3) if slow else (0.25, 1.2)
+                return travel_time(dist, v * self.speed, a) if dist else 0.0
+            case 'MoveJoint' if len(args) == 6 and None not in args:
+                dist = max(abs(math.radians(q - p)) for p, q in zip(self.joints or args, args))
+                self.joints = args
+                v, a = (0.25, 0.3) if slow else (1.05, 1.4)
+                return travel_time(dist, v * self.speed, a) if dist else 0.0
+            case 'GripperMove':
+                return 0.1
+            case 'GripperCheck':
+                return 1.7
+            case 'sleep' if args and isinstance(args[0], (int, float)):
+                return float(args[0])
+            case 'textmsg':
+                self.emit(text_of(call))
+            case 'socket_send_line':
+                if m := re.match(r'set speed ([\d.]+)$', text_of(call)):
+                    self.speed = float(m.group(1))
+            case _:
+                pass
+        return 0.0
+
+    def emit(self, text: str):
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.quiet:
+            print(f'{text = }')
+        self.broadcast(text_packet(text))
+
+    def broadcast(self, data: bytes):
+        with self.lock:
+            clients = [*self.clients]
+        for conn in clients:
+            try:
+                conn.sendall(data)
+            except OSError:
+                self.disconnect(conn)
+
+    def send_states(self):
+        state = packet(RobotState, bytes(32))
+        while self.server and self.server.fileno() != -1:
+            self.broadcast(state)
+            time.sleep(self.state_interval)
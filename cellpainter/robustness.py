@@ -0,0 +1,74 @@
+'''
+How likely a schedule is to keep its incubation times
+
+The timed commands of a resolved program are given durations drawn from their
+timings in estimates.json and the program is timed on its critical path graph.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+import random
+
+from . import utils
+from .commands import Command, Duration
+from .critical_path import graph
+from .estimates import EstCmd, exact_duration, percentile, sample_timings
+
+@dataclass(frozen=True)
+class Robustness:
+    on_time: dict[str, float]
+    makespans: list[float]
+    tolerance: float
+
+    def report(self) -> list[str]:
+        lines = [
+            f'makespan p50: {utils.pp_secs(percentile(self.makespans, 50))}',
+            f'makespan p90: {utils.pp_secs(percentile(self.makespans, 90))}',
+            f'probability of incubations within {self.tolerance}s:',
+        ]
+        for name, p in self.on_time.items():
+            lines += [f'  {p:6.1%}  {name}']
+        if self.on_time:
+            lines += [f'  {min(self.on_time.values()):6.1%}  (least)']
+        return lines
+
+def robustness(program: Command, samples: int = 500, tolerance: float = 1.0, seed: int = 0) -> Robustness:
+    '''
+    The probability that each exact duration is kept within tolerance seconds
+    and the distribution of the makespan.
+    '''
+    g = graph(program)
+    base = g.durations()
+    spread = [
+        (i, times)
+        for i, (cmd, _) in enumerate(g.cmds)
+        if isinstance(cmd, EstCmd)
+        if (times := sample_timings(cmd))
+    ]
+    exact = [
+        (i, g.checkpoints[cmd.name], exactly, cmd.name)
+        for i, (cmd, _) in enumerate(g.cmds)
+        if isinstance(cmd, Duration)
+        if (exactly := exact_duration(cmd)) is not None
+    ]
+    rng = random.Random(seed)
+    hits = [0] * len(exact)
+    makespans: list[float] = []
+    for _ in range(samples):
+        durations = [*base]
+        for i, times in spread:
+            durations[i] = rng.choice(times)
+        start, end = g.times(durations)
+        makespans.append(max(end, default=0.0))
+        for k, (i, checkpoint, exactly, _) in enumerate(exact):
+            if abs(start[i] - end[checkpoint] - exactly) <= tolerance:
+                hits[k] += 1
+    return Robustness(
+        on_time={
+            name: hits[k] / samples
+            for k, (_, _, _, name) in enumerate(exact)
+        },
+        makespans=makespans,
+        tolerance=tolerance,
+    )
@@ -15,14 +15,15 @@ from datetime import datetime, timedelta
 from queue import Queue
 from threading import RLock
 
-from .robotarm import Robotarm
+from .robotarm import Robotarm, RobotarmConnection
 from . import utils
 from .utils import pp_secs
 
-from .timelike import Timelike, WallTime, SimulatedTime
+from .timelike import Timelike, WallTime, EventTime
 from .moves import World, Effect
 
-from .log import LogEntry, Metadata, Error, Running, Log
+from .log import LogEntry, Metadata, Error, Running, RunningDelta, Log, Snapshot, snapshot_filename
+from .log_writer import LogWriter, FsyncPolicy
 
 import time
 
@@ -45,16 +46,21 @@ class ResumeConfig:
     start_time: datetime
     checkpoint_times: dict[str, float]
     secs_ago: float = 0.0
+    finished: list[str] = field(default_factory=list[str])
 
     @staticmethod
     def init(log: Log, now: datetime | None | str=None):
+        return ResumeConfig.from_snapshot(Snapshot().update(log), now)
+
+    @staticmethod
+    def from_snapshot(snapshot: Snapshot, now: datetime | None | str=None):
         if isinstance(now, str):
             now = datetime.fromisoformat(now)
         if now is None:
             now = datetime.now()
-        start_time = log.zero_time()
+        start_time = datetime.fromisoformat(snapshot.start_time)
         secs_ago = (now - start_time).total_seconds()
-        return ResumeConfig(start_time, log.checkpoints(), secs_ago)
+        return ResumeConfig(start_time, snapshot.checkpoint_times, secs_ago, snapshot.finished)
 
 @dataclass(frozen=True)
 class Keep:
@@ -74,6 +80,10 @@ class RuntimeConfig:
     running_log_filename: str | None = None
     log_to_file: bool = True
     resume_config: ResumeConfig | None = None
+    use_asyncio: bool = False
+    log_fsync: FsyncPolicy = 'batch'
+    snapshot_interval: float = 60.0
+    event_store: str | None = None
 
     def make_runtime(self) -> Runtime:
         resume_config = self.resume_config
@@ -83,6 +93,7 @@ class RuntimeConfig:
                 timelike=self.make_timelike(),
                 start_time=resume_config.start_time,
                 checkpoint_times=resume_config.checkpoint_times.copy(),
+                finished={*resume_config.finished},
             )
         else:
             return Runtime(
@@ -95,8 +106,8 @@ class RuntimeConfig:
         if resume_config:
             if self.timelike_factory is WallTime:
                 return WallTime(start_time=time.monotonic() - resume_config.secs_ago)
-            elif self.timelike_factory is SimulatedTime:
-                return SimulatedTime(skipped_time=resume_config.secs_ago)
+            elif self.timelike_factory is EventTime:
+                return EventTime(now=resume_config.secs_ago)
             else:
                 raise ValueError(f'Unknown timelike factory {self.timelike_factory} on config object')
         else:
@@ -108,6 +119,8 @@ class RuntimeConfig:
         running_log_filename: Keep | str | None          = keep,
         log_to_file:          Keep | bool                = keep,
         resume_config:        Keep | ResumeConfig | None = keep,
+        use_asyncio:          Keep | bool                = keep,
+        event_store:          Keep | str | None          = keep,
     ):
         next = self
         updates = dict(
@@ -116,6 +129,8 @@ class RuntimeConfig:
             running_log_filename=running_log_filename,
             log_to_file=log_to_file,
             resume_config=resume_config,
+            use_asyncio=use_asyncio,
+            event_store=event_store,
         )
         for k, v in updates.items():
             if v is keep:
@@ -132,7 +147,7 @@ configs = [
     RuntimeConfig('simulator', WallTime,      robotarm_env=RobotarmEnvs.simulator, run_incu_wash_disp=False),
     RuntimeConfig('forward',   WallTime,      robotarm_env=RobotarmEnvs.forward,   run_incu_wash_disp=False),
     RuntimeConfig('dry-wall',  WallTime,      robotarm_env=RobotarmEnvs.dry,       run_incu_wash_disp=False),
-    RuntimeConfig('dry-run',   SimulatedTime, robotarm_env=RobotarmEnvs.dry,       run_incu_wash_disp=False),
+    RuntimeConfig('dry-run',   EventTime,     robotarm_env=RobotarmEnvs.dry,       run_incu_wash_disp=False),
 ]
 
 def config_lookup(name: str) -> RuntimeConfig:
@@ -164,6 +179,9 @@ def get_robotarm(config: RuntimeConfig, quiet: bool = False, include_gripper: bo
         with_gripper = False
     return Robotarm.init(config.robotarm_env.host, config.robotarm_env.port, with_gripper, quiet=quiet)
 
+# Number of deltas between the full states in the running log
+RunningKeyframeInterval = 100
+
 import typing
 class CheckpointLike(typing.Protocol):
     name: str
@@ -178,9 +196,11 @@ class Runtime:
     incu: STX    | None = None
     wash: Biotek | None = None
     disp: Biotek | None = None
+    robotarm: RobotarmConnection | None = None
 
     log_entries: list[LogEntry] = field(default_factory=list)
     lock: RLock = field(default_factory=RLock)
+    writer: LogWriter = field(init=False)
 
     start_time: datetime = field(default_factory=datetime.now)
 
@@ -189,13 +209,18 @@ class Runtime:
         lambda: defaultdict[str, list[Queue[None]]](list)
     )
 
+    finished: set[str] = field(default_factory=set[str])
+    snapshot: Snapshot | None = None
+
     def __post_init__(self):
+        self.writer = LogWriter(fsync=self.config.log_fsync)
         self.register_thread('main')
 
         if self.config.name != 'dry-run':
             def handle_signal(signum: int, _frame: Any):
                 pid = os.getpid()
                 self.log(LogEntry(err=Error(f'Received {signal.strsignal(signum)}, shutting down ({pid=})')))
+                self.writer.drain()
                 self.stop_arm()
                 sys.exit(1)
 
@@ -224,6 +249,24 @@ class Runtime:
     def get_robotarm(self, quiet: bool = True, include_gripper: bool = True) -> Robotarm:
         return get_robotarm(self.config, quiet=quiet, include_gripper=include_gripper)
 
+    def robotarm_connection(self) -> RobotarmConnection:
+        '''
+        The connection to the robot arm that the commands of this runtime share.
+        Stopping the arm uses a connection of its own so that it is not held up
+        by a running command.
+        '''
+        with self.lock:
+            if self.robotarm is None:
+                env = self.config.robotarm_env
+                assert env.mode != 'noop'
+                self.robotarm = RobotarmConnection(env.host, env.port)
+            return self.robotarm
+
+    def close(self):
+        self.writer.close()
+        if self.robotarm is not None:
+            self.robotarm.close()
+
     def stop_arm(self):
         sync = Queue[None]()
 
@@ -240,9 +283,9 @@ class Runtime:
             pass
 
     def set_robotarm_speed(self, speed: int):
-        arm = self.get_robotarm(quiet=False, include_gripper=False)
-        arm.set_speed(speed)
-        arm.close()
+        if self.config.robotarm_env.mode == 'noop':
+            return
+        self.robotarm_connection().set_speed(speed)
 
     def spawn(self, f: Callable[[], None]) -> None:
         def F():
@@ -256,7 +299,11 @@ class Runtime:
             yield
         except BaseException as e:
             import reprlib
-            self.log(LogEntry(err=Error(reprlib.repr(e), traceback.format_exc())))
+            try:
+                self.log(LogEntry(err=Error(reprlib.repr(e), traceback.format_exc())))
+                self.writer.drain()
+            except BaseException:
+                traceback.print_exc()
             if not isinstance(e, SystemExit):
                 os.kill(os.getpid(), signal.SIGTERM)
 
@@ -269,9 +316,9 @@ class Runtime:
                 t=t,
                 t0=t0,
             )
-            if entry.running:
+            if entry.running or entry.running_delta:
                 if self.config.running_log_filename:
-                    utils.serializer.write_jsonl([entry], self.config.running_log_filename, mode='a')
+                    self.writer.write(self.config.running_log_filename, entry)
                 return entry
             # the logging logic is quite convoluted so let's safeguard against software errors in it
             try:
@@ -286,10 +333,35 @@ class Runtime:
                 print(entry.err.traceback, file=sys.stderr)
             log_filename = self.config.log_filename
             if log_filename:
-                utils.serializer.write_jsonl([entry], log_filename, mode='a')
+                self.writer.write(log_filename, entry)
             self.log_entries.append(entry)
+            if (i := entry.metadata.id) and entry.is_end_or_inf():
+                self.finished.add(i)
+            if self.snapshot and t - self.snapshot.t >= self.config.snapshot_interval:
+                self.write_snapshot()
             return entry
 
+    def start_snapshots(self, snapshot: Snapshot):
+        '''
+        Writes the snapshot updated with the state of the runtime now and then.
+        '''
+        with self.lock:
+            self.snapshot = snapshot
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        with self.lock:
+            log_filename = self.config.log_filename
+            if not self.snapshot or not log_filename:
+                return
+            self.snapshot = replace(
+                self.snapshot,
+                t=round(self.monotonic(), 3),
+                finished=sorted(self.finished),
+                checkpoint_times={**self.checkpoint_times},
+            )
+            self.writer.put(snapshot_filename(log_filename), self.snapshot)
+
     def apply_effect(self, effect: Effect, entry: LogEntry | None = None):
         with self.lock:
             try:
@@ -319,7 +391,7 @@ class Runtime:
             m = entry.metadata
             if entry.err:
                 pass
-            elif entry.cmd is None and entry.running:
+            elif entry.cmd is None and (entry.running or entry.running_delta):
                 return
             elif not self.config.log_filename:
                 return
@@ -380,33 +452,55 @@ class Runtime:
     def running(self) -> Running:
         with self.lock:
             return Running(
-                entries=self.running_entries,
+                entries=[*self.running_entries],
                 world=self.world,
             )
 
+    running_logged: Running | None = None
+    running_deltas: int = 0
+
     def log_running(self):
+        '''
+        Logs the change of the running state, and the full state every
+        RunningKeyframeInterval lines so that readers can start from there.
+        Nothing is logged without a running log, as for estimates and simulations.
+        '''
+        if not self.config.running_log_filename:
+            return
         with self.lock:
-            self.log(LogEntry(running=self.running()))
+            running = self.running()
+            prev = self.running_logged
+            if prev is None or self.running_deltas >= RunningKeyframeInterval:
+                self.log(LogEntry(running=running))
+                self.running_deltas = 0
+            else:
+                self.log(LogEntry(running_delta=RunningDelta.diff(prev, running)))
+                self.running_deltas += 1
+            self.running_logged = running
 
     def timeit(self, entry: LogEntry) -> ContextManager[None]:
         # The inferred type for the decorated function is wrong hence this wrapper to get the correct type
 
         @contextmanager
         def worker():
+            # the running entries are only for the running log and the lines printed with it
+            running = bool(self.config.running_log_filename)
             with self.lock:
                 e0 = self.log(entry)
-                self.running_entries.append(e0)
-                G = utils.group_by(self.running_entries, key=lambda e: e.metadata.thread_resource)
-                if self.config.name == 'dry-run':
-                    for thread_resource, v in G.items():
-                        if thread_resource is not None:
-                            assert len(v) <= 1, f'list for {thread_resource} should not have more than one element: {utils.pr(v)}'
-                self.log_running()
+                if running:
+                    self.running_entries.append(e0)
+                    G = utils.group_by(self.running_entries, key=lambda e: e.metadata.thread_resource)
+                    if self.config.name == 'dry-run':
+                        for thread_resource, v in G.items():
+                            if thread_resource is not None:
+                                assert len(v) <= 1, f'list for {thread_resource} should not have more than one element: {utils.pr(v)}'
+                    self.log_running()
             yield
             with self.lock:
                 self.log(entry, t0=e0.t)
-                self.running_entries.remove(e0)
-                self.log_running()
+                if running:
+                    self.running_entries.remove(e0)
+                    self.log_running()
 
         return worker()
 
@@ -421,16 +515,24 @@ class Runtime:
         return self.timelike.monotonic()
 
     def sleep(self, secs: float, entry: LogEntry):
+        self.timelike.sleep(self.log_sleep(secs, entry))
+
+    def log_sleep(self, secs: float, entry: LogEntry) -> float:
+        '''
+        Logs the sleep and returns the number of seconds to actually sleep.
+        '''
         secs = round(secs, 3)
         entry = entry.add(Metadata(sleep_secs=secs))
         if abs(secs) < 0.1:
             self.log(entry.add(msg=f'on time {pp_secs(secs)}s'))
+            return 0.0
         elif secs < 0:
             self.log(entry.add(msg=f'behind time {pp_secs(secs)}s'))
+            return 0.0
         else:
             to = self.pp_time_offset(self.monotonic() + secs)
             self.log(entry.add(msg=f'sleeping to {to} ({pp_secs(secs)}s)'))
-            self.timelike.sleep(secs)
+            return secs
 
     def queue_get(self, queue: Queue[A]) -> A:
         return self.timelike.queue_get(queue)
@@ -0,0 +1,104 @@
+'''
+Content-addressed on-disk cache of solved schedules
+
+The key is a hash of the resource-checkpointed program together with the
+estimates it consults, so a cached schedule is only reused when the solver
+would be given exactly the same problem.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+from pathlib import Path
+import hashlib
+import json
+import os
+
+from .commands import Command
+from .estimates import estimate, EstCmd
+from . import utils
+
+# Bump when the constraint model changes so that old entries are not reused
+version = 3
+
+def canonical_hash(cmd: Command, salt: str = '') -> str:
+    '''
+    Hash of the command tree and the estimates of all its timed commands.
+    '''
+    tree = utils.serializer.to_json(cmd)
+    ests = {
+        str(c): estimate(c)
+        for c in cmd.universe()
+        if isinstance(c, EstCmd)
+    }
+    blob = json.dumps(
+        {
+            'version': version,
+            'salt': salt,
+            'tree': tree,
+            'estimates': ests,
+        },
+        sort_keys=True,
+        separators=(',', ':'),
+    )
+    return hashlib.sha256(blob.encode()).hexdigest()
+
+@dataclass(frozen=True)
+class ScheduleCache:
+    '''
+    Size-bounded least recently used cache of schedules, one json file per key.
+
+    Recency is tracked by the file modification time which is bumped on every hit.
+    '''
+    dir: Path = Path('cache/schedules')
+    max_entries: int = 200
+    max_bytes: int = 200 * 1024 * 1024
+
+    def path(self, key: str) -> Path:
+        return self.dir / (key + '.json')
+
+    def get(self, key: str) -> dict[str, Any] | None:
+        path = self.path(key)
+        try:
+            with open(path, 'r') as f:
+                value = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return value
+
+    def put(self, key: str, value: dict[str, Any]):
+        self.dir.mkdir(parents=True, exist_ok=True)
+        path = self.path(key)
+        tmp = path.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(value, f)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries: list[tuple[float, int, Path]] = []
+        for p in self.dir.glob('*.json'):
+            try:
+                st = p.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort(reverse=True)
+        total = 0
+        for i, (_, size, p) in enumerate(entries):
+            total += size
+            if i >= self.max_entries or total > self.max_bytes:
+                try:
+                    p.unlink()
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        for p in self.dir.glob('*.json'):
+            p.unlink(missing_ok=True)
+
+default_cache = ScheduleCache()
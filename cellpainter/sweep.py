@@ -0,0 +1,145 @@
+'''
+Sweep over cell painting configurations and compare their schedules
+
+Each point is scheduled and run against the time estimates in a worker
+process. The schedules go through the constraints cache so repeated
+sweeps only solve new points.
+'''
+from __future__ import annotations
+from dataclasses import *
+from typing import *
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import contextlib
+import io
+import itertools as it
+
+from . import protocol
+from . import protocol_paths
+from .commands import RobotarmCmd
+from .estimates import incubation_deviations
+from .log import Log
+from .runtime import dry_run
+
+# The interleavings that can be used for the steps before the final wash.
+# three is left out: it moves a plate to B21 while another plate is still there
+# and there are no robot arm programs for it, so it can not be run.
+sweep_interleavings = 'lin june mix quad'.split()
+
+@dataclass(frozen=True)
+class SweepPoint:
+    batch_sizes: str
+    incu: str
+    interleaving: str
+    two_final_washes: bool
+    lockstep: bool
+
+@dataclass(frozen=True)
+class SweepResult:
+    point: SweepPoint
+    makespan: float = 0.0
+    incu_deviation: float = 0.0
+    robot_utilization: float = 0.0
+    error: str = ''
+
+def sweep_points(batch_sizes: list[str], incus: list[str]) -> list[SweepPoint]:
+    return [
+        SweepPoint(
+            batch_sizes=bs,
+            incu=incu,
+            interleaving=ilv,
+            two_final_washes=two_final_washes,
+            lockstep=lockstep,
+        )
+        for bs, incu, ilv, two_final_washes, lockstep in it.product(
+            batch_sizes,
+            incus,
+            sweep_interleavings,
+            [False, True],
+            [False, True],
+        )
+    ]
+
+def point_program(point: SweepPoint, protocol_dir: str):
+    paths = protocol_paths.get_protocol_paths()[protocol_dir]
+    args = protocol.ProtocolArgs(
+        incu=point.incu,
+        interleave=point.interleaving != 'lin',
+        two_final_washes=point.two_final_washes,
+        lockstep=point.lockstep,
+    )
+    config = protocol.make_protocol_config(paths, args)
+    config = replace(
+        config,
+        interleavings=[
+            point.interleaving if ilv in ('lin', 'june') else ilv
+            for ilv in config.interleavings
+        ],
+    )
+    batch_sizes = [int(b) for b in point.batch_sizes.split(',')]
+    return protocol.cell_paint_program(batch_sizes, config)
+
+def log_stats(point: SweepPoint, log: Log) -> SweepResult:
+    makespan = log.max_t()
+    deviations = [deviation for _, deviation in incubation_deviations(log)]
+    robot = sum(
+        (
+            d
+            for x in log
+            if isinstance(x.cmd, RobotarmCmd)
+            if (d := x.duration) is not None
+        ),
+        0.0,
+    )
+    return SweepResult(
+        point=point,
+        makespan=round(makespan, 1),
+        incu_deviation=round(max(deviations, default=0.0), 1),
+        robot_utilization=round(robot / makespan, 3) if makespan else 0.0,
+    )
+
+def run_point(point: SweepPoint, protocol_dir: str) -> SweepResult:
+    '''
+    Schedules the point and runs it against the estimates like the start of a
+    real run does, but without a runtime that stops the process on errors.
+    '''
+    from .execute import schedule_program, simulate
+    try:
+        program = point_program(point, protocol_dir)
+        with contextlib.redirect_stdout(io.StringIO()):
+            _, program, _ = schedule_program(program.remove_noops())
+            runtime = dry_run.replace(log_to_file=False).make_runtime()
+            simulate(program, runtime)
+        return log_stats(point, runtime.get_log())
+    except Exception as e:
+        return SweepResult(point=point, error=repr(e))
+
+header = 'batch_sizes incu interleaving two_final_washes lockstep makespan incu_deviation robot_utilization error'.split()
+
+def row(res: SweepResult) -> list[str]:
+    p = res.point
+    return [
+        p.batch_sizes,
+        p.incu,
+        p.interleaving,
+        str(p.two_final_washes),
+        str(p.lockstep),
+        str(res.makespan),
+        str(res.incu_deviation),
+        str(res.robot_utilization),
+        res.error,
+    ]
+
+def sweep(points: list[SweepPoint], protocol_dir: str, max_workers: int | None = None) -> Iterator[SweepResult]:
+    '''
+    Yields the results as they complete.
+    '''
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(run_point, p, protocol_dir) for p in points]
+        for f in as_completed(futures):
+            yield f.result()
+
+def print_sweep(points: list[SweepPoint], protocol_dir: str):
+    print(*header, sep='\t')
+    for res in sweep(points, protocol_dir):
+        print(*row(res), sep='\t', flush=True)
@@ -1,6 +1,7 @@
 from __future__ import annotations
 from typing import *
 import typing
+import types
 
 import argparse
 
@@ -84,6 +85,9 @@ class Arg:
                     parser.add_argument(opt_name, dest=f.name, action="store_const", const=opt.value, help=opt.help)
             else:
                 f_type = eval(f.type)
+                if typing.get_origin(f_type) in (Union, types.UnionType):
+                    # optional such as int | None: parse as the type that is not None
+                    f_type, = [t for t in typing.get_args(f_type) if t is not type(None)]
                 if f_type == list or typing.get_origin(f_type) == list:
                     parser.add_argument(dest=f.name, default=default, nargs="*", help=self.helps.get(f))
                 elif f_type == bool:
@@ -1,19 +1,24 @@
 from __future__ import annotations
 from dataclasses import is_dataclass, fields, MISSING
+from functools import cache
 from typing import Any
 
+@cache
+def field_defaults(t: type) -> list[tuple[str, Any, Any]]:
+    return [(f.name, f.default, f.default_factory) for f in fields(t)]
+
 def nub(x: Any) -> dict[str, Any]:
     assert is_dataclass(x)
     out: dict[str, Any] = {}
-    for f in fields(x):
-        a = getattr(x, f.name)
+    for name, default, default_factory in field_defaults(type(x)):
+        a = getattr(x, name)
         if (
-            isinstance(a, dict | set | list)
+            default_factory is not MISSING
+            and isinstance(a, dict | set | list)
             and not a
-            and f.default_factory is not MISSING
-            and not f.default_factory()
+            and not default_factory()
         ):
             continue
-        if a != f.default:
-            out[f.name] = a
+        if a != default:
+            out[name] = a
     return out
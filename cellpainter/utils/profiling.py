@@ -6,23 +6,29 @@ from contextlib import contextmanager
 
 import time
 
-def timeit(desc: str='') -> ContextManager[None]:
+def timeit(desc: str='') -> ContextManager[dict[str, Any]]:
+    '''
+    Prints the time spent in the block. The block can add key-value pairs
+    to the yielded dict and these are printed after the description.
+    '''
     # The inferred type for the decorated function is wrong hence this wrapper to get the correct type
 
     @contextmanager
     def worker():
         e = None
+        info: dict[str, Any] = {}
         t0 = time.monotonic()
         try:
-            yield
+            yield info
         except Exception as exn:
             e = exn
         T = time.monotonic() - t0
+        extra = [f'{k}={v}' for k, v in info.items()]
         if e:
-            print(f'{T:.3f}', desc, repr(e))
+            print(f'{T:.3f}', desc, *extra, repr(e))
             raise e
         else:
-            print(f'{T:.3f}', desc)
+            print(f'{T:.3f}', desc, *extra)
 
     return worker()
 
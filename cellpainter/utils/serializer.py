@@ -4,21 +4,136 @@ from typing import *
 
 from pathlib import Path
 import json
+import math
+import mmap
+import os
+import re
 
-from .nub import nub
+@dataclass(frozen=True)
+class JsonBackend:
+    '''
+    Encodes and decodes json. The backends write compact json with non-ascii
+    characters as they are so that they give the same bytes.
+
+    NaN and infinities are not json: orjson would write them as null and the
+    json module as NaN and Infinity, which orjson can not read. The serializer
+    raises ValueError for them instead, see to_json, and the json module
+    backend does not read them either.
+    '''
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[bytes | memoryview], Any]
+
+StringOrExponent = re.compile(rb'("(?:[^"\\]|\\.)*")|(-?\d)(\.\d+)?e([-+]\d+)')
+
+def orjson_exponent(m: re.Match[bytes]) -> bytes:
+    '''
+    Writes a float in exponent notation the way orjson does: without the plus
+    sign and leading zeros of the exponent and in decimal notation from 1e-5.
+    '''
+    if m.group(1):
+        return m.group(1)
+    lead, frac, exp = m.group(2), m.group(3) or b'', int(m.group(4))
+    if exp == -5:
+        sign, digit = lead[:-1], lead[-1:]
+        return sign + b'0.0000' + digit + frac[1:]
+    else:
+        return lead + frac + b'e' + str(exp).encode()
+
+def reject_constant(name: str) -> Any:
+    raise ValueError(f'{name} is not json')
+
+def stdlib_backend() -> JsonBackend:
+    encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False, allow_nan=False)
+    decoder = json.JSONDecoder(parse_constant=reject_constant)
+    def dumps(x: Any) -> bytes:
+        out = encoder.encode(x).encode()
+        if re.search(rb'\de[-+]\d', out):
+            out = StringOrExponent.sub(orjson_exponent, out)
+        return out
+    return JsonBackend(
+        'json',
+        dumps=dumps,
+        loads=lambda b: decoder.decode((bytes(b) if isinstance(b, memoryview) else b).decode()),
+    )
+
+def orjson_backend() -> JsonBackend | None:
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return JsonBackend(
+        'orjson',
+        dumps=lambda x: orjson.dumps(x, option=orjson.OPT_NON_STR_KEYS),
+        loads=orjson.loads,
+    )
+
+def default_backend() -> JsonBackend:
+    '''
+    orjson if it is installed, otherwise the json module
+    '''
+    return orjson_backend() or stdlib_backend()
+
+Atoms: tuple[type, ...] = (str, int, float, bool, type(None))
+
+def non_finite(x: float) -> ValueError:
+    return ValueError(f'{x} is not json')
+
+@dataclass(frozen=True)
+class Codec:
+    '''
+    How to encode one dataclass: its fields with their defaults and whether
+    they are left out when empty. Made once per class and cached.
+    '''
+    cls: Any
+    name: str
+    fields: list[tuple[str, Any, bool]]
+
+def make_codec(cls: Any) -> Codec:
+    return Codec(
+        cls,
+        cls.__name__,
+        [
+            (
+                f.name,
+                f.default,
+                f.default_factory is not MISSING and not f.default_factory(),
+            )
+            for f in fields(cls)
+        ],
+    )
 
 @dataclass(frozen=True)
 class Serializer:
     classes: dict[str, Any] = field(default_factory=dict)
+    codecs: dict[Any, Codec] = field(default_factory=dict[Any, Codec])
+    backend: JsonBackend = field(default_factory=default_backend)
+
     def register(self, classes: dict[str, Any]):
         self.classes.update({k: v for k, v in classes.items() if is_dataclass(v)})
+        self.codecs.clear()
+
+    def codec(self, cls: Any) -> Codec:
+        codec = self.codecs.get(cls)
+        if codec is None:
+            codec = make_codec(cls)
+            assert self.classes[codec.name] == cls
+            self.codecs[cls] = codec
+        return codec
 
     def from_json(self, x: Any) -> Any:
-        if isinstance(x, dict):
+        if x.__class__ in Atoms:
+            return x
+        elif isinstance(x, dict):
             x = cast(dict[str, Any], x)
             if type := x.get('type'):
                 cls = self.classes[type]
-                return cls(**{k: self.from_json(v) for k, v in x.items() if k != "type"})
+                from_json = self.from_json
+                return cls(**{
+                    k: v if v.__class__ in Atoms else from_json(v)
+                    for k, v in x.items()
+                    if k != "type"
+                })
             else:
                 return {k: self.from_json(v) for k, v in x.items()}
         elif isinstance(x, list):
@@ -29,12 +144,26 @@ class Serializer:
             raise ValueError()
 
     def to_json(self, x: Any) -> dict[str, Any] | list[Any] | None | float | int | bool | str:
-        if is_dataclass(x):
-            d = nub(x)
-            cls = x.__class__
-            type = cls.__name__
-            assert self.classes[type] == cls
-            return self.to_json({'type': type, **d})
+        t: type[Any] = x.__class__
+        if t in Atoms:
+            if t is float and not math.isfinite(x):
+                raise non_finite(x)
+            return x
+        codec = self.codecs.get(t)
+        if codec is None and is_dataclass(x) and not isinstance(x, type):
+            codec = self.codec(t)
+        if codec is not None:
+            to_json = self.to_json
+            out: dict[str, Any] = {'type': codec.name}
+            for name, default, skip_empty in codec.fields:
+                a: Any = getattr(x, name)
+                if skip_empty and not a and isinstance(a, dict | set | list):
+                    continue
+                if a != default:
+                    if a.__class__ is float and not math.isfinite(a):
+                        raise non_finite(a)
+                    out[name] = a if a.__class__ in Atoms else to_json(a)
+            return out
         elif isinstance(x, dict):
             return {k: self.to_json(v) for k, v in cast(dict[str, Any], x).items()}
         elif isinstance(x, list):
@@ -44,24 +173,52 @@ class Serializer:
         else:
             raise ValueError()
 
+    def dumps(self, x: Any) -> bytes:
+        return self.backend.dumps(self.to_json(x))
+
+    def loads(self, b: bytes | memoryview) -> Any:
+        return self.from_json(self.backend.loads(b))
+
     def read_jsonl(self, path: str | Path) -> Iterator[Any]:
-        with open(path, 'r') as f:
-            for line in f:
-                yield self.from_json(json.loads(line))
+        '''
+        Decodes the lines of a memory-mapped file without copying them when
+        the backend accepts memoryviews.
+        '''
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if not size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                start = 0
+                while start < size:
+                    end = m.find(b'\n', start)
+                    if end == -1:
+                        end = size
+                    if end > start:
+                        with memoryview(m)[start:end] as line:
+                            x = self.loads(line)
+                        yield x
+                    start = end + 1
 
     def read_json(self, path: str | Path) -> Any:
-        with open(path, 'r') as f:
-            return self.from_json(json.load(f))
+        with open(path, 'rb') as f:
+            return self.loads(f.read())
 
     def write_jsonl(self, xs: Iterable[Any], path: str | Path, mode: Literal['w', 'a']='w'):
-        with open(path, mode) as f:
+        with open(path, mode + 'b') as f:
             for x in xs:
-                json.dump(self.to_json(x), f)
-                f.write('\n')
+                f.write(self.dumps(x) + b'\n')
 
     def write_json(self, x: Any, path: str | Path, indent: int | None = None):
-        with open(path, 'w') as f:
-            json.dump(self.to_json(x), f, indent=indent)
+        '''
+        Indented json is written with the json module.
+        '''
+        if indent is None:
+            with open(path, 'wb') as f:
+                f.write(self.dumps(x))
+        else:
+            with open(path, 'w') as f:
+                json.dump(self.to_json(x), f, indent=indent)
 
 serializer = Serializer()
 from_json = serializer.from_json